@@ -1,60 +1,319 @@
-import copy
-
+import itertools
 import pyparsing as pp
 import re
 
+import StellarisScriptParser
 from model import SmoosherDataModel
 
 
-class dict_list(dict):
-    def __setitem__(self, key, value):
-        try:
-            self[key]
-        except KeyError:
-            super(dict_list, self).__setitem__(key, [])
+# Bump this whenever a change to the parsers or the data model would change (or break) previously cached results
+PARSER_VERSION = 9
+
+# Source normalisation patterns, see _pre_process_source. These are equivalent to the original expressions but avoid
+# rescanning: comments are only looked ahead once rather than per character and braces are matched by their preceding
+# character rather than by every possible start of the preceding word.
+_DEPENDENCIES = re.compile(r"^dependencies={[^}]*}$", re.MULTILINE)
+_TAGS = re.compile(r"^tags={[^}]*}$", re.MULTILINE)
+_COMMENT = re.compile(r"#(?![^\n]*ORIGIN)[^\n]*")
+_MISSING_EQUALS = re.compile(r"([A-Za-z0-9_.\-]){")
+_QUOTED_KEY = re.compile(r"\"([A-Za-z0-9_.\-]+)\"\s*=")
+_BLOCK_SPACING = re.compile(r"=\s*{")
+_EMPTY_OBJECT = re.compile(r"^\s*{\s*\}", re.MULTILINE)
+
+
+class _values(list):
+    # Marks a key that holds several values so that single values can be stored inline
+    __slots__ = ()
+
+
+_missing = object()
+
+
+# Ordered multimap allowing duplicate keys, as our file format does. Indexing a key always returns the list of values
+# assigned to it, but internally single values are held inline as most keys are never duplicated.
+class dict_list(object):
+    __slots__ = ("_items",)
+    __hash__ = None
 
+    def __init__(self):
+        self._items = dict()
+
+    def __setitem__(self, key, value):
+        items = self._items
         if isinstance(value, list):
-            self[key].extend(value)
+            if key not in items:
+                items[key] = _values()
+            for item in value:
+                self.__setitem__(key, item)
+            return
+
+        current = items.get(key, _missing)
+        if current is _missing:
+            items[key] = value
+        elif type(current) is not _values:
+            items[key] = _values((current, value))
+        elif len(current) > 0:
+            current.append(value)
         else:
-            self[key].append(value)
+            items[key] = value
+
+    def __getitem__(self, key):
+        current = self._items[key]
+        if type(current) is _values:
+            return current
+
+        return [current]
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
 
     def __eq__(self, other):
         if not isinstance(other, dict_list):
             return False
 
-        if "value" in self and "value" in other:
-            return self["value"] == other["value"]
+        if "value" in self._items and "value" in other._items:
+            return self._items["value"] == other._items["value"]
 
-        return super().__eq__(other)
+        return self._items == other._items
 
     def __ne__(self, other):
-        if not isinstance(other, dict_list):
-            return True
+        return not self.__eq__(other)
 
-        if "value" in self and "value" in other:
-            return self["value"] != other["value"]
+    def __repr__(self):
+        return "dict_list(" + repr(dict(self.items())) + ")"
 
-        return super().__ne__(other)
+    def keys(self):
+        return self._items.keys()
+
+    def values(self):
+        return [self[key] for key in self._items]
+
+    def items(self):
+        return [(key, self[key]) for key in self._items]
+
+    def get(self, key, default=None):
+        if key in self._items:
+            return self[key]
+
+        return default
+
+    def pop(self, key, *default):
+        if key not in self._items and len(default) > 0:
+            return default[0]
+
+        values = self[key]
+        del self._items[key]
+        return values
 
     def copy(self):
-        return copy.deepcopy(self)
+        # Only our containers are copied, values are immutable so they can be shared
+        clone = dict_list()
+        for key, current in self._items.items():
+            if type(current) is _values:
+                clone._items[key] = _values(_copy_value(item) for item in current)
+            else:
+                clone._items[key] = _copy_value(current)
+
+        return clone
+
+
+def _copy_value(value):
+    if isinstance(value, dict_list):
+        return value.copy()
+
+    if isinstance(value, dict):
+        return {key: _copy_value(item) for key, item in value.items()}
+
+    return value
+
+
+class StellarisGrammar(object):
+    # The grammar is expensive to construct so we only ever build it once per process. Packrat memoisation is available
+    # but off by default as it slows our (barely backtracking) grammar down, see benchmarks/parser_throughput.py
+    __instance = None
+    packrat_cache_size = 1024
+
+    @classmethod
+    def get(cls, packrat=False):
+        if cls.__instance is None:
+            if packrat:
+                pp.ParserElement.enablePackrat(cls.packrat_cache_size)
+            cls.__instance = StellarisGrammar()
+
+        return cls.__instance
+
+    def __init__(self):
+        # Generate a string type that handles quoted and unquoted
+        self.unquoted = pp.Word(pp.alphanums + pp.alphas8bit + "_-.:?@[]")
+        self.unquoted.setName("unquoted_string")
+        self.quoted = pp.dblQuotedString.copy()
+        self.quoted.setName("quoted_string")
+        string_type = (self.quoted | self.unquoted)
+        string_type.setName("string")
+
+        # Generate a value type that handles all data types
+        real = pp.Regex(r"[+-]?\d+\.\d*").setParseAction(lambda x: float(x[0]))
+        integer = pp.Regex(r"[+-]?\d+").setParseAction(lambda x: int(x[0]))
+        yes = pp.CaselessKeyword("yes").setParseAction(pp.replaceWith(True))
+        no = pp.CaselessKeyword("no").setParseAction(pp.replaceWith(False))
+        self.value_type = (real | integer | yes | no | self.quoted | self.unquoted)
+        self.value_type.setName("value")
+
+        # Handle our special cased attributes
+        self.assignment = (string_type + "=" + self.value_type)
+        self.assignment.setName("assignment")
+
+        # Handle our queries
+        self.query = (string_type + pp.oneOf([">", "<", ">=", "<="]) + self.value_type)
+        self.query.setName("query")
+
+        # Handle our empties
+        self.empty = pp.Empty().setParseAction(pp.replaceWith(""))
+        self.empty.setName("empty")
+
+        self.origin = (pp.Suppress("#ORIGIN = ") + string_type)
+        self.origin.setName("Origin")
+
+        # Block is an encapsulation of something else
+        self.block = pp.Forward()
+        self.block << (
+                string_type + "=" + pp.Suppress("{") +
+                pp.Group(
+                    pp.OneOrMore(
+                        pp.Group(
+                            (self.block | self.assignment | self.query | self.value_type) + pp.Optional(self.origin)
+                        )
+                    )
+                    | self.empty)
+                + pp.Suppress("}") + pp.Optional(self.origin))
+        self.block.setName("block")
+
+        # We can either have a direct assignment or a block
+        self.expressions = (self.assignment | self.block)
+        self.expressions.setName("expression")
+
+        # Set the whole doc
+        self.statement = pp.Group(self.expressions + pp.Optional(self.origin))
+        self.statement.parseWithTabs()
+        self.statement.setName("statement")
+        self.document = pp.OneOrMore(self.statement)
+        self.document.parseWithTabs()
+        self.document.setName("document")
+
+        # When recovering we parse as much as we can and report where we stopped as the final token
+        self.partial_document = pp.ZeroOrMore(self.statement) + pp.Empty().setParseAction(lambda s, loc, t: loc)
+        self.partial_document.parseWithTabs()
+        self.partial_document.setName("partial_document")
+
+    def set_debug(self, flag):
+        for element in (self.quoted, self.unquoted, self.value_type, self.assignment, self.query, self.empty,
+                        self.origin, self.block, self.expressions, self.statement, self.document):
+            element.setDebug(flag)
 
 
 class StellarisDataParser(object):
+    engines = ["pyparsing", "native"]
+
+    # Sources at least twice this size are split into pieces of around this size when there is a pool to parse them on
+    chunk_size = 256 * 1024
+
+    def __init__(self, packrat=False, engine="pyparsing", cache=None, recover=False):
+        if engine not in self.engines:
+            print("Unknown parser engine: " + engine)
+            exit(1)
+
+        self._engine = engine
+        self._cache = cache
+        self._recover = recover
+        if engine == "native":
+            self._native_parser = StellarisScriptParser.StellarisScriptParser()
+        else:
+            self._grammar = StellarisGrammar.get(packrat)
+
     def parse_text(self, mod, file, src, debug=False):
+        # Legacy interface, the dict_list view is only derived for callers that still want it
+        model = self.parse_model(mod, file, src, debug)
+        if model is None:
+            return None, None
+
+        return self.derive_document(model), model
+
+    def parse_model(self, mod, file, src, debug=False, executor=None):
+        if self._cache is None:
+            return self._parse_model(mod, file, src, debug, executor)
+
+        # Unchanged files can skip the parse entirely
+        key = self._cache.key(self._engine + ("+recover" if self._recover else ""), mod, src)
+        model = self._cache.load(key)
+        if model is not None:
+            print("Loaded from cache: " + file)
+            return model
+
+        model = self._parse_model(mod, file, src, debug, executor)
+        if model is not None:
+            self._cache.store(key, model)
+
+        return model
+
+    def _parse_model(self, mod, file, src, debug, executor=None):
         src = self._pre_process_source(src)
 
         # Check if src is now just whitespace (comment only files)
         if src.isspace():
             print("No content found in: " + file)
-            return None, None
+            return None
+
+        # Big files are split between their top level statements so that the pieces can be parsed at the same time
+        starts = None
+        if executor is not None and len(src) >= self.chunk_size * 2:
+            starts = StellarisScriptParser.split_statements(src, self.chunk_size)
 
-        # Parse our data
+        if starts is not None and len(starts) > 1:
+            print("Parsing in " + str(len(starts)) + " chunks: " + file)
+            return self._parse_chunks(mod, src, starts, executor)
+
+        # Parse our data, in a worker if we have them as we are probably on a thread that only coordinates them
         print("Parsing: " + file)
-        data = self._parse_grammar(src, debug=debug)
-        document = self._derive_document(mod, data)
+        if executor is not None:
+            return executor.submit(parse_chunk, mod, src).result()
+
+        return self._parse_source(mod, src, debug)
+
+    def _parse_chunks(self, mod, src, starts, executor):
+        chunks = [src[start:end] for start, end in zip(starts, starts[1:] + [len(src)])]
+        graphs = executor.map(parse_chunk, itertools.repeat(mod, len(chunks)), chunks)
+
+        # Stitch the pieces back together in order, moving their diagnostics to where they are in the whole source
+        document = SmoosherDataModel.Document(mod, mod)
+        for start, graph in zip(starts, graphs):
+            line = src.count("\n", 0, start)
+            for diagnostic in graph.diagnostics:
+                document.add_diagnostic(SmoosherDataModel.Diagnostic(diagnostic.line + line, diagnostic.column,
+                                                                     diagnostic.message))
+
+            document.adopt(graph)
+
+        return document
+
+    def _parse_source(self, mod, src, debug):
+        if self._engine == "native":
+            return self._native_parser.parse(src, mod, self._recover)
+
+        if not self._recover:
+            return self._derive_model(self._parse_grammar(src, debug=debug), mod)
+
+        data, diagnostics = self._parse_grammar_recovering(src, debug=debug)
         model = self._derive_model(data, mod)
-        return document, model
+        for diagnostic in diagnostics:
+            model.add_diagnostic(diagnostic)
+
+        return model
 
     def _derive_model(self, source, fallback_source):
         document = SmoosherDataModel.Document(fallback_source, fallback_source)
@@ -67,7 +326,7 @@ class StellarisDataParser(object):
     def __derive_model_content(self, root_document, source, parent, fallback_source):
         # Loop through our root statement
         for statement in source:
-            if len(statement) == 1:
+            if len(statement) <= 2:
                 attribute = self._derive_weird_attribute(root_document, statement, fallback_source)
                 parent.add_attribute(attribute)
 
@@ -94,7 +353,7 @@ class StellarisDataParser(object):
 
         # Check for statement lists
         if isinstance(statement[2], pp.ParseResults):
-            return self.__derive_model_content(statement[2], node, fallback_source)
+            return self.__derive_model_content(root_document, statement[2], node, fallback_source)
 
         print("There is an error with the format of your parsed document.")
         exit(1)
@@ -108,248 +367,168 @@ class StellarisDataParser(object):
         return SmoosherDataModel.Attribute(root_document, statement[0], statement[1], statement[2], source)
 
     def _derive_weird_attribute(self, root_document, statement, fallback_source):
-        if len(statement) != 4:
+        if len(statement) != 2:
             source = fallback_source
         else:
-            source = statement[3]
+            source = statement[1]
         return SmoosherDataModel.ListAttribute(root_document, statement[0], source)
 
     def _pre_process_source(self, src):
         # Remove tags & dependencies which fuck everything up because they are formatted weirdly
-        src = re.sub(r"^dependencies={[^}]*}$", "", src, flags=re.MULTILINE)
-        src = re.sub(r"^tags={[^}]*}$", "", src, flags=re.MULTILINE)
-        src = re.sub(r"#((?!ORIGIN).)*$", "", src,
-                     flags=re.MULTILINE)  # Remove comments - I wish i could think of a good way to keep them
-        src = re.sub(r"([A-Za-z0-9_.\-]+){", r"\1={", src)  # Solve phrases without equal sign
-        src = re.sub(r"\"([A-Za-z0-9_.\-]+)\"\s*=", r"\1=", src, 0, re.MULTILINE)  # Unquote keys in phrases
-        src = re.sub(r"=\s*{", r"={", src, 0, re.MULTILINE)  # Fix spaces
-        src = re.sub(r"^\s*{\s*\}", r"", src, 0, re.MULTILINE)  # Hack for random empty objects start of the line
+        if "dependencies={" in src:
+            src = _DEPENDENCIES.sub("", src)
+        if "tags={" in src:
+            src = _TAGS.sub("", src)
+
+        # Remove comments - I wish i could think of a good way to keep them
+        if "#" in src:
+            src = _COMMENT.sub("", src)
+
+        src = _MISSING_EQUALS.sub(r"\1={", src)  # Solve phrases without equal sign
+        if '"' in src:
+            src = _QUOTED_KEY.sub(r"\1=", src)  # Unquote keys in phrases
+        src = _BLOCK_SPACING.sub("={", src)  # Fix spaces
+        src = _EMPTY_OBJECT.sub("", src)  # Hack for random empty objects start of the line
         return src
 
     def _parse_grammar(self, src, debug=True):
-        # Generate a string type that handles quoted and unquoted
-        unquoted = pp.Word(pp.alphanums + pp.alphas8bit + "_-.:?@[]")
-        unquoted.setName("unquoted_string")
-        pp.dblQuotedString.setName("quoted_string")
-        string_type = (pp.dblQuotedString | unquoted)
-        string_type.setName("string")
-
-        # Generate a value type that handles all data types
-        real = pp.Regex(r"[+-]?\d+\.\d*").setParseAction(lambda x: float(x[0]))
-        integer = pp.Regex(r"[+-]?\d+").setParseAction(lambda x: int(x[0]))
-        yes = pp.CaselessKeyword("yes").setParseAction(pp.replaceWith(True))
-        no = pp.CaselessKeyword("no").setParseAction(pp.replaceWith(False))
-        value_type = (real | integer | yes | no | pp.dblQuotedString | unquoted)
-        value_type.setName("value")
-
-        # Handle our special cased attributes
-        assignment = (string_type + "=" + value_type)
-        assignment.setName("assignment")
-
-        # Handle our queries
-        query = (string_type + pp.oneOf([">", "<", ">=", "<="]) + value_type)
-        query.setName("query")
-
-        # Handle our empties
-        empty = pp.Empty().setParseAction(pp.replaceWith(""))
-        empty.setName("empty")
-
-        origin = (pp.Suppress("#ORIGIN = ") + string_type)
-        origin.setName("Origin")
-
-        # Block is an encapsulation of something else
-        block = pp.Forward()
-        block << (
-                string_type + "=" + pp.Suppress("{") +
-                pp.Group(
-                    pp.OneOrMore(
-                        pp.Group(
-                            # pp.OneOrMore(
-                            #     pp.Group(
-                            (block | assignment | query | value_type) + pp.Optional(origin)
-                            #     )
-                            # )
-                        )
-                    )
-                    | empty)
-                + pp.Suppress("}") + pp.Optional(origin))
-        block.setName("block")
-
-        # We can either have a direct assignment or a block
-        expressions = (assignment | block)
-        expressions.setName("expression")
-
-        # Set the whole doc
-        document = pp.OneOrMore(pp.Group(expressions + pp.Optional(origin)))
-        document.parseWithTabs()
-        document.setName("document")
-
         if debug:
-            pp.dblQuotedString.setDebug()
-            unquoted.setDebug()
-            value_type.setDebug()
-            assignment.setDebug()
-            query.setDebug()
-            empty.setDebug()
-            origin.setDebug()
-            block.setDebug()
-            expressions.setDebug()
-            document.setDebug()
+            self._grammar.set_debug(True)
 
         try:
-            return document.parseString(src, parseAll=True)
+            return self._grammar.document.parseString(src, parseAll=True)
         except pp.ParseException as pe:
             # Prints the last lines to cause the error, sometimes not very useful
             print(pp.ParseException.explain(pe, depth=None))
-            print("Recording attempt")
-
-            if not debug:
-                pp.dblQuotedString.setDebug()
-                unquoted.setDebug()
-                value_type.setDebug()
-                assignment.setDebug()
-                query.setDebug()
-                empty.setDebug()
-                origin.setDebug()
-                block.setDebug()
-                expressions.setDebug()
-                document.setDebug()
-                document.parseString(src, parseAll=True)
-
             raise pe  # Should throw exception, not exit
+        finally:
+            if debug:
+                self._grammar.set_debug(False)
 
-    def _derive_document(self, mod, source):
-        document = dict_list()  # Allows duplicate keys in root - ideally we wouldn't want this but hey ho not my file format
-        for statement in source:
-            # Check if the first statement is a key
-            if isinstance(statement[0], str):
-                statement_content = self._derive_statement(mod, statement)
-            else:
-                continue
+    def _parse_grammar_recovering(self, src, debug=True):
+        if debug:
+            self._grammar.set_debug(True)
 
-            # Can do a check here to see if any keys from statement content are already present in document
-            # if any(item in document for item in statement_content):
-            #     print("Duplicate key in source document. This is a big error. Figure it out.")
-            #     return None
+        statements = list()
+        diagnostics = list()
+        offset = 0
+        try:
+            while True:
+                data = self._grammar.partial_document.parseString(src[offset:])
+                statements.extend(data[:-1])
+                stop = offset + data[-1]
+                if stop >= len(src):
+                    break
+
+                # Re-parse only the failing statement for a more useful error location, then skip to the next block
+                try:
+                    self._grammar.statement.parseString(src[stop:])
+                    position, message = stop, "Expected a statement"
+                except pp.ParseException as pe:
+                    position, message = stop + pe.loc, pe.msg
+
+                diagnostics.append(SmoosherDataModel.Diagnostic(pp.lineno(position, src), pp.col(position, src), message))
+                offset = StellarisScriptParser.find_next_statement(src, stop)
+        finally:
+            if debug:
+                self._grammar.set_debug(False)
+
+        return statements, diagnostics
+
+    def derive_document(self, model):
+        document = dict_list()  # Allows duplicate keys in root - ideally we wouldn't want this but hey ho not my file format
+        for attribute in model.attributes:
+            document[attribute.key] = self._derive_statement(attribute)[attribute.key]
 
-            # Compound dict
-            for key, item in statement_content.items():
-                document[key] = item
+        for node in model.children:
+            document[node.key] = self._derive_statement(node)[node.key]
 
         return document
 
-    def _derive_statement(self, mod, statement):
+    def _derive_statement(self, holder):
         properties = dict_list()
-
-        if isinstance(statement[2], pp.ParseResults):
-            properties["type"] = statement[1] + "{"
-            if len(statement) != 4:
-                properties["source"] = mod
-            else:
-                properties["source"] = statement[3]
-            if len(statement[2]) == 1 and statement[2][0] == '':
+        properties["source"] = holder.source
+        if isinstance(holder, SmoosherDataModel.Node):
+            properties["type"] = "={"
+            if len(holder.attributes) == 0 and len(holder.children) == 0:
                 properties["value"] = ""
-            elif len(statement[2]) == 1 and isinstance(statement[2][0], str):
-                properties["value"] = statement[2][0]
-            else:
-                for item in statement[2]:
-                    if isinstance(item, pp.ParseResults) and len(item) == 1:
-                        properties["value"] = item[0]
-                    else:
-                        properties["value"] = self._derive_statement(mod, item)
+
+            for attribute in holder.attributes:
+                if isinstance(attribute, SmoosherDataModel.ListAttribute):
+                    properties["value"] = attribute.key
+                else:
+                    properties["value"] = self._derive_statement(attribute)
+
+            for node in holder.children:
+                properties["value"] = self._derive_statement(node)
+
         else:
-            if len(statement) != 4:
-                properties["source"] = mod
-            else:
-                properties["source"] = statement[3]
-            properties["type"] = statement[1]
-            properties["value"] = statement[2]
+            properties["type"] = holder.type
+            properties["value"] = holder.value
 
-        return {statement[0]: properties}
+        return {holder.key: properties}
 
-    def dump(self, file_tree, file, graph):
+    def dump(self, file, graph):
         print("Creating file: " + file)
         with open(file, "w") as file_handle:
             #self._write(file_tree, 0, real_file)
             graph.write(file_handle, 0)
 
     def _write(self, tree, tab_count, file_handle):
+        lines = list()
         for key, value in tree.items():
             for item in value:  # Further nesting allows for duplicate keys
-                self._write_block(key, item["type"], item["value"], item["source"], tab_count, file_handle)
+                self._write_block(key, item["type"], item["value"], item["source"], tab_count, lines)
 
-    def _write_tree(self, tree, tab_count, file_handle):
+        file_handle.write("".join(lines))
+
+    def _write_tree(self, tree, tab_count, lines):
         for key, value in tree.items():
-            self._write_block(key, value["type"], value["value"], value["source"], tab_count, file_handle)
+            self._write_block(key, value["type"], value["value"], value["source"], tab_count, lines)
 
-    def _write_block(self, key, assignment_type, value, source, tab_count, file_handle):
-        tabs = "    " * tab_count
+    def _write_block(self, key, assignment_type, value, source, tab_count, lines):
+        tabs = SmoosherDataModel.indent(tab_count)
         if isinstance(value, list) and assignment_type[0][-1] == "{":
-            file_handle.write(tabs + key + " " + assignment_type[0][0] + " {\n")
-            tab_count += 1
+            lines.append(tabs + key + " " + assignment_type[0][0] + " {\n")
             for item in value:
                 if isinstance(item, dict):
-                    self._write_tree(item, tab_count,
-                                     file_handle)  # Realistically we should only have 1 item in here so we could redirect straight to _write_block with some wiggling
+                    self._write_tree(item, tab_count + 1, lines)  # Realistically we should only have 1 item in here so we could redirect straight to _write_block with some wiggling
                 else:
-                    file_handle.write(tabs + "    " + self.__correct_value(item) + "\n")
-            tab_count -= 1
-            file_handle.write(tabs + "} #ORIGIN = " + source[0].replace(" ", "_") + "\n")
-
-        else:
-            file_handle.write(
-                tabs + key + " " + assignment_type[0] + " " + self.__correct_value(value) + " #ORIGIN = " + source[
-                    0].replace(" ", "_") + "\n")
-
-    def __correct_value(self, value):
-        if isinstance(value, list):
-            value = value[0]
+                    lines.append(SmoosherDataModel.indent(tab_count + 1) + SmoosherDataModel.correct_value(item) + "\n")
+            lines.append(tabs + "} #ORIGIN = " + source[0].replace(" ", "_") + "\n")
 
-        if isinstance(value, bool):
-            if value:
-                string_value = "yes"
-            else:
-                string_value = "no"
         else:
-            string_value = str(value)
-
-        return string_value
+            lines.append(tabs + key + " " + assignment_type[0] + " " + SmoosherDataModel.correct_value(value) +
+                         " #ORIGIN = " + source[0].replace(" ", "_") + "\n")
 
     def conflict_to_text(self, key, conflict):
-        master_text = self._write_to_text(key, conflict["master"], 0, "")
-        conflict_text = self._write_to_text(key, conflict["conflicting"], 0, "")
+        master_text = self._write_to_text(key, conflict["master"], 0)
+        conflict_text = self._write_to_text(key, conflict["conflicting"], 0)
         return master_text, conflict_text
 
-    def _write_to_text(self, key, items, tab_count, target_text):
+    def _write_to_text(self, key, items, tab_count):
+        lines = list()
         for block in items:
-            target_text = self._write_block_to_text(key, block["type"], block["value"], block["source"], tab_count,
-                                                    target_text)
+            self._write_block(key, block["type"], block["value"], block["source"], tab_count, lines)
 
-        return target_text
+        return "".join(lines)
 
-    def _write_tree_to_text(self, tree, tab_count, target_text):
-        for key, value in tree.items():
-            target_text = self._write_block_to_text(key, value["type"], value["value"], value["source"], tab_count,
-                                                    target_text)
 
-        return target_text
+# Process pool entry points. Each worker builds its own parser (and therefore grammar) once and reuses it
+_worker_parser = None
 
-    def _write_block_to_text(self, key, assignment_type, value, source, tab_count, target_text):
-        tabs = "    " * tab_count
-        if isinstance(value, list) and assignment_type[0][-1] == "{":
-            target_text += tabs + key + " " + assignment_type[0][0] + " {\n"
-            tab_count += 1
-            for item in value:
-                if isinstance(item, dict):
-                    target_text = self._write_tree_to_text(item, tab_count,
-                                                           target_text)  # Realistically we should only have 1 item in here so we could redirect straight to _write_block with some wiggling
-                else:
-                    target_text += tabs + "    " + self.__correct_value(item) + "\n"
-            tab_count -= 1
-            target_text += tabs + "} #ORIGIN = " + source[0].replace(" ", "_") + "\n"
 
-        else:
-            target_text += tabs + key + " " + assignment_type[0] + " " + self.__correct_value(value) + " #ORIGIN = " + \
-                           source[0].replace(" ", "_") + "\n"
+def initialise_worker(options):
+    global _worker_parser
+    _worker_parser = StellarisDataParser(**options)
+
+
+def parse_file(mod, source, member):
+    src = source.read_text(member)
+    return _worker_parser.parse_model(mod, source.describe(member), src, debug=False)
+
 
-        return target_text
+def parse_chunk(mod, src):
+    # Pieces of a larger file (or the whole of one that couldn't be split), see StellarisDataParser._parse_model. These
+    # have already been pre-processed.
+    return _worker_parser._parse_source(mod, src, debug=False)
@@ -1,12 +1,150 @@
+import collections
 import glob
+import hashlib
+import io
 import os
 import shutil
+import time
 import zipfile
 
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    with open(path, "rb") as digest_file:
+        return _stream_digest(digest_file)
+
+
+def _stream_digest(stream):
+    # Digests are trusted to mean identical content, so these need to be strong and comparable between sources
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(_COPY_BUFFER_SIZE), b""):
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class DirectoryModSource:
+    # Serves a mod's files from a directory on disk. Files are identified by their '/' separated path within the mod.
+    def __init__(self, path):
+        self.path = path
+
+    def list_files(self):
+        for root, nested, files in os.walk(self.path):
+            relative_root = os.path.relpath(root, self.path)
+            for file in files:
+                if relative_root == ".":
+                    yield file
+                else:
+                    yield relative_root.replace(os.sep, "/") + "/" + file
+
+    def describe(self, member):
+        return os.path.join(self.path, *member.split("/"))
+
+    def read_text(self, member):
+        with open(self.describe(member), "r") as mod_file:
+            return mod_file.read()
+
+    def stamp(self, member):
+        # Cheap to obtain and changes whenever the content (probably) does
+        stat = os.stat(self.describe(member))
+        return stat.st_mtime_ns, stat.st_size
+
+    def digest(self, member):
+        return file_digest(self.describe(member))
+
+    def checksum(self, member):
+        return None  # Nothing cheaper than a digest
+
+    def size(self, member):
+        return os.stat(self.describe(member)).st_size
+
+    def modified_time(self, member):
+        return os.stat(self.describe(member)).st_mtime_ns
+
+    def copy_to(self, member, destination, link=True):
+        # A hardlink costs no I/O at all, otherwise let shutil use whatever in kernel copy the platform has
+        source_file = self.describe(member)
+        if link:
+            try:
+                os.link(source_file, destination)
+                return
+            except OSError:
+                pass
+
+        shutil.copyfile(source_file, destination)
+        shutil.copystat(source_file, destination)
+
+
+class ArchiveModSource:
+    # Serves a mod's files straight out of its archive without extracting anything. Archives are opened lazily and kept
+    # open per process, as sources are sent to worker processes for every file they parse.
+    _open_archives = dict()
+
+    def __init__(self, path):
+        self.path = path
+
+    def _archive(self):
+        # Forked worker processes must not share their parent's file handles
+        process, archive = self._open_archives.get(self.path, (None, None))
+        if process != os.getpid():
+            archive = zipfile.ZipFile(self.path, "r")
+            self._open_archives[self.path] = (os.getpid(), archive)
+
+        return archive
+
+    def list_files(self):
+        for member in self._archive().infolist():
+            if not member.is_dir():
+                yield member.filename
+
+    def describe(self, member):
+        return self.path + "/" + member
+
+    def read_text(self, member):
+        # Decode exactly as we would have read the file from disk
+        with io.TextIOWrapper(self._archive().open(member, "r")) as mod_file:
+            return mod_file.read()
+
+    def stamp(self, member):
+        info = self._archive().getinfo(member)
+        return info.date_time + (info.file_size, info.CRC)
+
+    def digest(self, member):
+        with self._archive().open(member, "r") as member_file:
+            return _stream_digest(member_file)
+
+    def checksum(self, member):
+        # Archives already carry a checksum of every member. This is too weak to prove two members are identical, but
+        # members with different checksums certainly aren't.
+        return self._archive().getinfo(member).CRC
+
+    def size(self, member):
+        return self._archive().getinfo(member).file_size
+
+    def modified_time(self, member):
+        return int(time.mktime(self._archive().getinfo(member).date_time + (0, 0, -1))) * 1000000000
+
+    def copy_to(self, member, destination, link=True):
+        with self._archive().open(member, "r") as member_file, open(destination, "wb") as destination_file:
+            shutil.copyfileobj(member_file, destination_file, _COPY_BUFFER_SIZE)
+
+        # Carry the member's timestamp over so that we can tell the copy is up to date next time
+        modified_time = self.modified_time(member)
+        os.utime(destination, ns=(modified_time, modified_time))
+
+    @classmethod
+    def close_all(cls):
+        for process, archive in cls._open_archives.values():
+            if process == os.getpid():
+                archive.close()
+
+        cls._open_archives.clear()
+
 
 class StellarisModFilesystem:
 
-    def __init__(self, source, target, should_clean_if_required, mod):
+    def __init__(self, source, target, should_clean_if_required, mod, is_incremental=False):
         self.source = source
         self.target = target
 
@@ -19,18 +157,13 @@ class StellarisModFilesystem:
         # Create our mod directory
         if not os.path.exists(target):
             os.mkdir(target)
-        elif os.listdir(target):
+        elif os.listdir(target) and (should_clean_if_required or not is_incremental):
             if should_clean_if_required:
                 self.clean_directory(target)
             else:
                 print("Target mod exists and is not empty. If you wish to clean this folder rerun the program with third argument 'clean'")
                 exit(1)
 
-        # Create a staging zone for a place to unpack zipped mods for integration
-        self.stage_directory = os.path.join(target, "temporary_staging")
-        if not os.path.exists(self.stage_directory):
-            os.mkdir(self.stage_directory)
-
         # Create our mappings
         self._file_mappings = dict()
         for key, value in self.__raw_file_mappings.items():
@@ -50,11 +183,11 @@ class StellarisModFilesystem:
             for d in dirs:
                 shutil.rmtree(os.path.join(root, d))
 
-    def stage_mod(self, path):
-        with zipfile.ZipFile(path, "r") as zip_file:
-            zip_file.extractall(self.stage_directory)
+    def open_mod(self, path):
+        if path.endswith(".zip"):
+            return ArchiveModSource(path)
 
-        return self.stage_directory
+        return DirectoryModSource(path)
 
     def load_file(self, file):
         # Load in our data
@@ -63,37 +196,106 @@ class StellarisModFilesystem:
 
         return src
 
-    def calculate_intermediates(self, mod_root, full_file):
-        root_parts = self._split_path(mod_root)
-        file_parts = self._split_path(full_file)
-        return [x for x in file_parts if x not in root_parts]
-
-    def _split_path(self, path):
-        allparts = []
-        while 1:
-            parts = os.path.split(path)
-            if parts[0] == path:  # sentinel for absolute paths
-                allparts.insert(0, parts[0])
-                break
-            elif parts[1] == path:  # sentinel for relative paths
-                allparts.insert(0, parts[1])
-                break
-            else:
-                path = parts[0]
-                allparts.insert(0, parts[1])
-        return allparts
-
-    def create_intermediates(self, intermediates):
-        file = intermediates.pop()
-        current_path = self.target
-        for folder in intermediates:
-            current_path = os.path.join(current_path, folder)
-            if not os.path.exists(current_path):
-                os.mkdir(current_path)
-
-        file = self._translate_file(intermediates, file)
-        file = os.path.join(current_path, file)
-        return os.path.exists(file), file
+    def copy_file(self, source, member, file):
+        # Never linked, as a later run may smoosh into this target and would then be writing through to the mod itself
+        if os.path.lexists(file):
+            os.unlink(file)
+        else:
+            self.create_target_directory(file)
+
+        source.copy_to(member, file, link=False)
+
+    def migrate_assets(self, assets, executor, digest=None):
+        # Assets are copied as they are, keyed by their path within the target (the last mod providing a path wins).
+        # Copying a file from a directory is just a link, but archive members have to be extracted, so an archive member
+        # with the same content as another asset is linked to that copy instead. Callers can pass a digest function
+        # that remembers digests between runs.
+        digest = digest or (lambda source, member: source.digest(member))
+        migrated = executor.map(lambda asset: self._is_migrated(asset[0], *asset[1]), assets.items())
+        pending = [relative_file for relative_file, current in zip(assets, migrated) if not current]
+
+        # Every asset can be the original of a duplicate, including those that are already up to date
+        sizes = dict()
+        for relative_file, (source, member) in assets.items():
+            sizes.setdefault(source.size(member), list()).append(relative_file)
+
+        extracted = {relative_file for relative_file in pending
+                     if isinstance(assets[relative_file][0], ArchiveModSource)}
+        duplicates = dict()
+        for group in sizes.values():
+            if len(group) < 2 or extracted.isdisjoint(group):
+                continue  # A unique size means unique content, and linking saves nothing unless we'd extract something
+
+            # Archive members that no other file shares a checksum with can't be duplicates, so skip hashing them.
+            # That only holds if everything in the group has a checksum.
+            checksums = [assets[relative_file][0].checksum(assets[relative_file][1]) for relative_file in group]
+            if None not in checksums:
+                counts = collections.Counter(checksums)
+                group = [relative_file for relative_file, checksum in zip(group, checksums) if counts[checksum] > 1]
+
+            originals = dict()
+            for relative_file, content in zip(group, executor.map(lambda relative_file: digest(*assets[relative_file]),
+                                                                  group)):
+                if content not in originals:
+                    originals[content] = relative_file
+                elif relative_file in extracted:
+                    duplicates[relative_file] = originals[content]
+
+        # Duplicates can only be linked once the original exists
+        copies = [executor.submit(self._migrate_asset, relative_file, *assets[relative_file])
+                  for relative_file in pending if relative_file not in duplicates]
+        results = [copy.result() for copy in copies]
+        links = [executor.submit(self._link_asset, relative_file, original)
+                 for relative_file, original in duplicates.items()]
+        results.extend(link.result() for link in links)
+        results.extend(["unchanged"] * (len(assets) - len(pending)))
+        return {result: results.count(result) for result in ("copied", "linked", "unchanged")}
+
+    def _is_migrated(self, relative_file, source, member):
+        try:
+            stat = os.stat(os.path.join(self.target, *relative_file.split("/")))
+        except FileNotFoundError:
+            return False
+
+        return stat.st_size == source.size(member) and stat.st_mtime_ns == source.modified_time(member)
+
+    def _migrate_asset(self, relative_file, source, member):
+        destination = os.path.join(self.target, *relative_file.split("/"))
+        try:
+            os.unlink(destination)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        source.copy_to(member, destination)
+        return "copied"
+
+    def _link_asset(self, relative_file, original_file):
+        destination = os.path.join(self.target, *relative_file.split("/"))
+        original = os.path.join(self.target, *original_file.split("/"))
+        try:
+            stat = os.stat(destination)
+            original_stat = os.stat(original)
+            if (stat.st_size, stat.st_mtime_ns) == (original_stat.st_size, original_stat.st_mtime_ns):
+                return "unchanged"
+
+            os.unlink(destination)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        try:
+            os.link(original, destination)
+        except OSError:
+            shutil.copy2(original, destination)
+
+        return "linked"
+
+    def calculate_target(self, intermediates):
+        folders = intermediates[:-1]
+        file = self._translate_file(folders, intermediates[-1])
+        return os.path.join(self.target, *folders, file)
+
+    def create_target_directory(self, file):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
 
     __absolute_file_mappings = [
         "00_common_categories.txt",
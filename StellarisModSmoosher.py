@@ -1,12 +1,17 @@
+import argparse
+import concurrent.futures
+import multiprocessing
 import os
 import re
-import sys
 import tkinter as tk
 
 from gui import StellarisConflictResolverGUI
 import StellarisDataParser
 import StellarisModFilesystem
+import StellarisParseCache
+import StellarisRunManifest
 from model import SmoosherComparator
+from model import SmoosherMerger
 
 # TODO: Check for overriding events?
 
@@ -31,28 +36,225 @@ class StellarisModSmoosher:
         '.*\.gui'
     ]
 
-    def __init__(self, source, target, flags):
+    def __init__(self, source, target, flags, jobs=1, vanilla=None):
         self._source = source
         self._target = target
         self._flags = flags
+        self._jobs = jobs if jobs > 0 else os.cpu_count()
         self._tk_geometry = None
         self._tk_fullscreen = None
 
-        # Create a file system interface for our application
-        target_mod_directory = os.path.join(source_mod_directory, target)
+        # Create a file system interface for our application. A target we smooshed previously can be updated in place.
+        target_mod_directory = os.path.join(source, target)
+        is_incremental = StellarisRunManifest.StellarisRunManifest.exists(target_mod_directory)
         self._filesystem = StellarisModFilesystem.StellarisModFilesystem(source, target_mod_directory, "clean" in flags,
-                                                                         target)
-        self._parser = StellarisDataParser.StellarisDataParser()
+                                                                         target, is_incremental)
+        # Parse results are cached alongside the application, keyed by content, so they survive cleaning the target
+        cache = None
+        if "nocache" not in flags:
+            cache_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parse_cache")
+            cache = StellarisParseCache.StellarisParseCache(cache_directory, StellarisDataParser.PARSER_VERSION)
+            if "clear_cache" in flags:
+                cache.clear()
+
+        # Keep hold of our parser configuration so worker processes can build identical parsers
+        engine = "native" if "native" in flags else "pyparsing"
+        self._parser_options = {"engine": engine, "cache": cache, "recover": "recover" in flags}
+        self._parser = StellarisDataParser.StellarisDataParser(**self._parser_options)
+        self._differentiator = SmoosherComparator.TreeDifferentiator if "treediff" in flags else \
+            SmoosherComparator.DataDifferentiator
+
+        # Files skipped because their content had already been smooshed
+        self._duplicate_count = 0
+        self._vanilla_duplicate_count = 0
+
+        # Files with a single contributor that could be copied as they are
+        self._direct_copy_count = 0
+
+        # The unmodded game files, used as the common base when merging mods that edit the same file
+        self._vanilla = vanilla
+        self._vanilla_graphs = dict()
+
+        # What we built last time (if anything) and how, so that we only rebuild what has changed
+        manifest_options = {"parser": StellarisDataParser.PARSER_VERSION, "engine": engine,
+                            "recover": "recover" in flags, "treediff": "treediff" in flags, "vanilla": vanilla}
+        self._manifest = StellarisRunManifest.StellarisRunManifest(target_mod_directory, manifest_options)
+        self._executor = None
 
     def run(self):
-        # Loop through mods to identify file sets
-        was_staged = False
+        if self._jobs > 1:
+            # Assets are migrated on threads whilst we parse, and forking a process with threads running isn't safe
+            context = None
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+
+            with concurrent.futures.ProcessPoolExecutor(self._jobs, mp_context=context,
+                                                        initializer=StellarisDataParser.initialise_worker,
+                                                        initargs=(self._parser_options,)) as executor:
+                self._executor = executor
+                self._run()
+                self._executor = None
+        else:
+            self._run()
+
+    def _run(self):
+        # Work out everything we will need to do upfront so that only files with more than one contributor are merged
+        mods = self._discover_mods()
+        index, assets = self._index_files(mods)
+        index, signatures = self._filter_unchanged(index)
+
+        # Assets are simply copied so that I/O can happen in the background whilst we parse
+        for file in self._manifest.record_assets(assets):
+            print("Removing: " + file)
+            if os.path.isfile(file):
+                self._filesystem.remove_file(file)
+
+        with concurrent.futures.ThreadPoolExecutor(1) as coordinator, \
+                concurrent.futures.ThreadPoolExecutor(thread_name_prefix="assets") as asset_executor:
+            migration = coordinator.submit(self._filesystem.migrate_assets, assets, asset_executor,
+                                           self._manifest.hash_file)
+            self._smoosh_targets(index, signatures)
+            counts = migration.result()
+
+        print("Migrated " + str(len(assets)) + " assets: " + ", ".join(
+            str(count) + " " + result for result, count in counts.items()))
+        self._manifest.save()
+        StellarisModFilesystem.ArchiveModSource.close_all()
+        print("Rebuilt " + str(len(index)) + " target files, " + str(self._manifest.skipped) + " were unchanged")
+        print("Skipped " + str(self._duplicate_count) + " duplicate files, " + str(self._vanilla_duplicate_count) +
+              " of which were unmodified game files")
+        print("Copied " + str(self._direct_copy_count) + " files directly without parsing")
+
+    def _smoosh_targets(self, index, signatures):
+        index = self._remove_duplicates(index, signatures)
+        index = self._copy_uncontested(index, signatures)
+
+        # Parsing may happen out of order but we always merge in the original order to keep the output stable
+        contributors = [contributor for group in index.values() for contributor in group]
+        graphs = self._parse_files([contributor[0] for contributor in contributors],
+                                   [contributor[1] for contributor in contributors],
+                                   [contributor[2] for contributor in contributors])
+        for file, group in index.items():
+            master_graph = None
+            for name, source, member in group:
+                graph = next(graphs)
+                if graph is None:
+                    continue
+
+                # Anything we had to skip whilst parsing will be missing from the output so make some noise about it
+                for diagnostic in graph.diagnostics:
+                    print("Skipped malformed content in: " + source.describe(member) + " at " + str(diagnostic))
+
+                # The first contributor becomes our master
+                if master_graph is None:
+                    master_graph = graph
+                else:
+                    self._smoosh_file(file, os.path.join(*member.split("/")), master_graph, graph)
+
+            # Every target is written exactly once
+            if master_graph is not None:
+                self._filesystem.create_target_directory(file)
+                self._parser.dump(file, master_graph)
+                self._manifest.record(file, signatures[file])
+            else:
+                self._manifest.forget(file)
+
+    def _copy_uncontested(self, index, signatures):
+        # A file keeping its name that only one mod provides would come out the other side exactly as it went in, so
+        # skip the parse entirely and just copy its bytes over. Only collisions need to go through the parser.
+        remaining = dict()
+        for file, group in index.items():
+            name, source, member = group[0]
+            if len(group) > 1 or os.path.basename(file) != member.rsplit("/", 1)[-1]:
+                remaining[file] = group
+                continue
+
+            print("Copying file: " + source.describe(member) + " to: " + file)
+            self._filesystem.copy_file(source, member, file)
+            self._manifest.record(file, signatures[file])
+            self._direct_copy_count += 1
+
+        return remaining
+
+    def _remove_duplicates(self, index, signatures):
+        # A file identical to one already contributing to the same target (or to the game's copy it would be merged
+        # against) can't change the merged result, so there is no need to parse it. Our signatures already hold the
+        # digest of every contributor in order, followed by the game's copy when there is one.
+        deduplicated = dict()
+        for file, group in index.items():
+            signature = signatures[file]
+            originals = dict()
+            if len(signature) > len(group):
+                originals[signature[-1][2]] = (None, signature[-1][1])
+
+            kept = list()
+            for contributor, (name, description, digest) in zip(group, signature):
+                source, member = contributor[1], contributor[2]
+                original = originals.get(digest)
+
+                # Digests only tell us where to look, we still confirm the content matches before throwing it away
+                if kept and original is not None and self._read_original(original) == source.read_text(member):
+                    print("Skipping duplicate: " + description)
+                    self._duplicate_count += 1
+                    if original[0] is None:
+                        self._vanilla_duplicate_count += 1
+                    continue
+
+                originals.setdefault(digest, (source, member))
+                kept.append(contributor)
+
+            deduplicated[file] = kept
+
+        return deduplicated
+
+    def _read_original(self, original):
+        source, member = original
+        if source is None:
+            return self._filesystem.load_file(member)
+
+        return source.read_text(member)
+
+    def _filter_unchanged(self, index):
+        # Remove anything we built previously that nothing contributes to any more
+        for file in self._manifest.stale_targets(index):
+            print("Removing: " + file)
+            if os.path.isfile(file):
+                self._filesystem.remove_file(file)
+            self._manifest.forget(file)
+
+        # Only targets whose contributors have changed need rebuilding
+        changed = dict()
+        signatures = dict()
+        for file, group in index.items():
+            signature = self._manifest.signature(group, self._vanilla_file(file, group[0][2]))
+            if self._manifest.is_current(file, signature):
+                self._manifest.skipped += 1
+                continue
+
+            changed[file] = group
+            signatures[file] = signature
+
+        return changed, signatures
+
+    def _vanilla_file(self, file, member):
+        # The game file used as the base for merging this target, see _smoosh_file
+        relative_file = os.path.join(*member.split("/"))
+        if self._vanilla is None or os.path.basename(file) != os.path.basename(relative_file):
+            return None
+
+        return os.path.join(self._vanilla, relative_file)
+
+    def _discover_mods(self):
+        # Loop through mods to identify their names & where their content lives
+        mods = list()
         for mod_file in self._filesystem.source_files:
             mod_text = self._filesystem.load_file(mod_file)
-            data, graph = self._parser.parse_text(mod_file, mod_file, mod_text)
-            if data is None:
+            graph = self._parser.parse_model(mod_file, mod_file, mod_text)
+            if graph is None:
                 continue
 
+            data = self._parser.derive_document(graph)
+
             # Check for poorly formatted files
             name = ""
             path = ""
@@ -63,7 +265,7 @@ class StellarisModSmoosher:
                 path = data["path"][0]["value"][0]
 
             if "archive" in data:
-                path = data["path"][0]["archive"][0]
+                path = data["archive"][0]["value"][0]
 
             # Strip quotes for this if present and check for validity
             name = name.replace('"', "")
@@ -72,56 +274,87 @@ class StellarisModSmoosher:
                 print("Malformed mod: " + mod_file)
                 continue
 
-            # Handle archives
-            if path.endswith(".zip"):
-                was_staged = True
-                path = self._filesystem.stage_mod(path)
-
-            # Loop through every file
-            for root, nested, files in os.walk(path):
-                for file in files:
-                    full_file = os.path.join(root, file)
-
-                    # Check if file should be ignored
-                    if re.match("|".join(self.file_blacklist), full_file):
-                        continue
-
-                    # Check if files should me migrated
-                    if re.match("|".join(self.files_to_migrate), full_file):
-                        continue
-
-                    # Load our mod file into memory
-                    text = self._filesystem.load_file(full_file)
-                    tree, graph = self._parser.parse_text(name, full_file, text, debug=False)
-                    if tree is None:
-                        continue
-
-                    # Allow our filesystem to calculate what should be saved and what shouldn't
-                    self._smoosh_file(path, full_file, tree, graph)
-
-            # Clean up our staging directory for re-use
-            if was_staged:
-                self._filesystem.clean_directory(path)
-                was_staged = False
-
-    def _smoosh_file(self, mod_root, full_file, file_tree, graph):
-        # Calculate our folder hierarchy and create where necessary
-        intermediates = self._filesystem.calculate_intermediates(mod_root, full_file)
-        created_file, file = self._filesystem.create_intermediates(intermediates)
-
-        # Check if an existing master is present - if not just dump the tree
-        if not created_file:
-            self._parser.dump(file_tree, file, graph)
-            return
-
+            # Archives are read in place rather than extracted
+            mods.append((name, self._filesystem.open_mod(path)))
+
+        return mods
+
+    def _index_files(self, mods):
+        # Map every target file to the mod files that contribute to it, in load order. Assets to migrate are mapped to
+        # the last mod providing them.
+        index = dict()
+        assets = dict()
+        blacklist = re.compile("|".join(self.file_blacklist))
+        migrate = re.compile("|".join(self.files_to_migrate))
+        for name, source in mods:
+            for member in source.list_files():
+                full_file = source.describe(member)
+
+                # Check if file should be ignored
+                if blacklist.match(full_file):
+                    continue
+
+                # Check if files should me migrated
+                if migrate.match(full_file):
+                    assets[member] = (source, member)
+                    continue
+
+                # Allow our filesystem to calculate where this should be saved
+                target_file = self._filesystem.calculate_target(member.split("/"))
+                index.setdefault(target_file, list()).append((name, source, member))
+
+        collisions = sum(1 for group in index.values() if len(group) > 1)
+        print("Discovered " + str(len(index)) + " target files, " + str(collisions) + " of which need merging")
+        return index, assets
+
+    def _parse_files(self, names, sources, members):
+        if self._executor is None:
+            return (self._parse_file(name, source, member) for name, source, member in zip(names, sources, members))
+
+        # Big files would hold up whichever worker got them, so their pieces are spread over the whole pool instead.
+        # Everything else is handed out a file at a time, first, so the pool has work whilst we split the big ones.
+        large = [source.size(member) >= StellarisDataParser.StellarisDataParser.chunk_size * 2
+                 for source, member in zip(sources, members)]
+        graphs = self._executor.map(StellarisDataParser.parse_file,
+                                    *[[item for item, is_large in zip(items, large) if not is_large]
+                                      for items in (names, sources, members)])
+
+        # Splitting and stitching happen here rather than in a worker, so they run alongside whatever is merged first
+        splitter = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="splitter")
+        large_graphs = [splitter.submit(self._parse_file, name, source, member, self._executor)
+                        for name, source, member, is_large in zip(names, sources, members, large) if is_large]
+        splitter.shutdown(wait=False)
+        return self._in_order(large, iter(large_graphs), graphs)
+
+    def _in_order(self, large, large_graphs, graphs):
+        for is_large in large:
+            yield next(large_graphs).result() if is_large else next(graphs)
+
+    def _parse_file(self, name, source, member, executor=None):
+        # Load our mod file into memory
+        text = source.read_text(member)
+        return self._parser.parse_model(name, source.describe(member), text, debug=False, executor=executor)
+
+    def _smoosh_file(self, file, relative_file, master_graph, graph):
         # Conflict the existing
         print("Confilict handling!!!!")
-        master_text = self._filesystem.load_file(file)
-        master_tree, master_graph = self._parser.parse_text(os.path.basename(file), file, master_text, debug=False)
 
-        # identify and generate an indexed difference
-        differ = SmoosherComparator.DataDifferentiator(master_graph, graph)
-        differ.compare()
+        # When we know what the game originally had we can take any edits that don't overlap automatically. This only
+        # holds when every contributor to the target was a copy of the same game file, i.e. it was not renamed.
+        vanilla_graph = None
+        if os.path.basename(file) == os.path.basename(relative_file):
+            vanilla_graph = self._load_vanilla(relative_file)
+
+        if vanilla_graph is not None:
+            # Only edits that overlap are left for conflict resolution
+            differ = SmoosherMerger.ThreeWayMerge(vanilla_graph, master_graph, graph)
+            differ.merge()
+            print("Merged " + str(differ.merged_count) + " changes into: " + file + " with " +
+                  str(differ.get_conflict_count()) + " conflicts")
+        else:
+            # identify and generate an indexed difference
+            differ = self._differentiator(master_graph, graph)
+            differ.compare()
 
         # Maybe unnecessary as we have now moved to our own data model
         #conflicts, safe = self._identify_conflicts(file, file_tree, master_tree)
@@ -144,6 +377,22 @@ class StellarisModSmoosher:
             #           [CURRENT SECTION]
             #           [EDITABLE RESULT]
 
+    def _load_vanilla(self, relative_file):
+        if self._vanilla is None:
+            return None
+
+        # Every mod touching the same file shares the same base so only parse it once
+        if relative_file not in self._vanilla_graphs:
+            graph = None
+            vanilla_file = os.path.join(self._vanilla, relative_file)
+            if os.path.isfile(vanilla_file):
+                text = self._filesystem.load_file(vanilla_file)
+                graph = self._parser.parse_model("vanilla", vanilla_file, text, debug=False)
+
+            self._vanilla_graphs[relative_file] = graph
+
+        return self._vanilla_graphs[relative_file]
+
     def _resolve_conflicts(self, conflicts):
         resolved = StellarisDataParser.dict_list()
         for conflict_key, conflict_value in conflicts.items():
@@ -290,13 +539,20 @@ class StellarisModSmoosher:
     #     return current_conflicts, master_tree
 
 
-# Inputs TODO: Improve with argparse
-source_mod_directory = sys.argv[1]
-target_mod = sys.argv[2]
-flags = ""
-if len(sys.argv) == 4:
-    flags = sys.argv[3]
-
-# Create our application & run
-application = StellarisModSmoosher(source_mod_directory, target_mod, flags)
-application.run()
+if __name__ == "__main__":
+    # Inputs
+    argument_parser = argparse.ArgumentParser(description="Smoosh a directory of Stellaris mods into a single mod.")
+    argument_parser.add_argument("source", help="The directory containing your .mod descriptors")
+    argument_parser.add_argument("target", help="The name of the mod to create in the source directory")
+    argument_parser.add_argument("flags", nargs="?", default="",
+                                 help="Any combination of: clean, native, recover, nocache, clear_cache, treediff")
+    argument_parser.add_argument("--jobs", type=int, default=1,
+                                 help="Number of processes used to parse mod files, 0 uses every core")
+    argument_parser.add_argument("--vanilla", default=None,
+                                 help="The game's install directory, used as the base for three way merges")
+    arguments = argument_parser.parse_args()
+
+    # Create our application & run
+    application = StellarisModSmoosher(arguments.source, arguments.target, arguments.flags, arguments.jobs,
+                                       arguments.vanilla)
+    application.run()
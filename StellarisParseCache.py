@@ -0,0 +1,123 @@
+import hashlib
+import os
+import pickle
+import zlib
+
+
+class StellarisParseCache:
+    default_max_size = 512 * 1024 * 1024  # Half a gig is plenty for a few hundred mods
+    measure_interval = 32  # Stores between checking the real size of the cache
+
+    def __init__(self, directory, version, max_size=default_max_size):
+        self.directory = directory
+        self.version = str(version)
+        self.max_size = max_size
+        self._current_size = None
+        self._stores = 0
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, engine, mod, src):
+        # Our parse results depend on the fallback source (mod) as well as the content
+        digest = hashlib.sha256()
+        for part in (self.version, engine, mod):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        digest.update(src.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def load(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as cache_file:
+                data = cache_file.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        try:
+            result = pickle.loads(zlib.decompress(data))
+        except Exception:
+            # Corrupt or from an incompatible version of the model, just forget about it
+            print("Discarding unreadable cache entry: " + key)
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        # Touch our entry so that eviction is least recently used rather than least recently written
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return result
+
+    def store(self, key, value):
+        data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        path = os.path.join(self.directory, key)
+        temporary_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(temporary_path, "wb") as cache_file:
+            cache_file.write(data)
+        os.replace(temporary_path, path)
+
+        # Worker processes each have their own copy of the cache, so our running total misses what the others have
+        # written. Re-measure every so often, and always before deciding whether to evict.
+        self._stores += 1
+        if self._current_size is None or self._stores % self.measure_interval == 0:
+            self._current_size = self._calculate_size()
+        else:
+            self._current_size += len(data)
+            if self._current_size > self.max_size:
+                self._current_size = self._calculate_size()
+
+        if self._current_size > self.max_size:
+            self._evict()
+
+    def clear(self):
+        print("Clearing parse cache: " + self.directory)
+        for entry in os.listdir(self.directory):
+            self._remove(os.path.join(self.directory, entry))
+
+        self._current_size = 0
+
+    def _evict(self):
+        entries = self._scan()
+
+        # Drop the least recently used entries until we have a bit of headroom
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        target = self.max_size * 0.9
+        for mtime, entry_size, path in entries:
+            if size <= target:
+                break
+
+            self._remove(path)
+            size -= entry_size
+
+        self._current_size = size
+
+    def _calculate_size(self):
+        return sum(entry[1] for entry in self._scan())
+
+    def _scan(self):
+        # Other processes may be replacing or evicting entries whilst we look, so anything that vanishes is skipped
+        entries = list()
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                pass
+
+        return entries
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
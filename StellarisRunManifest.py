@@ -0,0 +1,110 @@
+import json
+import os
+
+import StellarisModFilesystem
+
+
+class StellarisRunManifest:
+    # Records what every target file in a smooshed mod was built from, so a rerun only rebuilds targets whose
+    # contributing files (or the way we build them) have changed
+    file_name = "smoosh_manifest.json"
+    version = 3
+
+    def __init__(self, target, options):
+        self.path = os.path.join(target, self.file_name)
+        self.options = options
+        self._files = dict()  # Previously seen source files -> [stamp, hash]
+        self._targets = dict()  # Target file (relative to our mod) -> signature it was built from
+        self._assets = list()  # Assets (relative to our mod) that were migrated
+        self._asset_files = set()  # Source files of this run's assets, whose hashes are worth keeping
+        self._target = target
+        self.skipped = 0  # Targets left untouched this run
+
+        try:
+            with open(self.path, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return
+
+        # Anything that changes how we build our output invalidates everything we built previously. We still need to
+        # know what that was though, so that anything no longer provided by a mod is removed.
+        self._targets = manifest.get("targets", dict())
+        self._assets = manifest.get("assets", list())
+        if manifest.get("version") != self.version or manifest.get("options") != options:
+            print("Smoosh options have changed since the last run, rebuilding everything")
+            self._targets = {relative: None for relative in self._targets}
+            return
+
+        self._files = manifest.get("files", dict())
+
+    @classmethod
+    def exists(cls, target):
+        return os.path.isfile(os.path.join(target, cls.file_name))
+
+    def signature(self, contributors, base=None):
+        # Who contributed what, in order, identified by content rather than timestamps
+        signature = [[name, source.describe(member), self.hash_file(source, member)]
+                     for name, source, member in contributors]
+        if base is not None and os.path.isfile(base):
+            signature.append(["vanilla", base, self._hash_path(base)])
+
+        return signature
+
+    def hash_file(self, source, member):
+        description = source.describe(member)
+        stamp = list(source.stamp(member))
+        previous = self._files.get(description)
+        if previous is not None and previous[0] == stamp:
+            digest = previous[1]
+        else:
+            digest = source.digest(member)
+
+        self._files[description] = [stamp, digest]
+        return digest
+
+    def _hash_path(self, path):
+        stat = os.stat(path)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        previous = self._files.get(path)
+        if previous is not None and previous[0] == stamp:
+            return previous[1]
+
+        digest = StellarisModFilesystem.file_digest(path)
+        self._files[path] = [stamp, digest]
+        return digest
+
+    def is_current(self, file, signature):
+        return self._targets.get(self._relative(file)) == signature and os.path.isfile(file)
+
+    def record(self, file, signature):
+        self._targets[self._relative(file)] = signature
+
+    def stale_targets(self, files):
+        # Targets we built previously that nothing contributes to any more
+        current = {self._relative(file) for file in files}
+        return [os.path.join(self._target, relative) for relative in self._targets if relative not in current]
+
+    def record_assets(self, assets):
+        # Assets map their path within our mod to the source and member they are copied from
+        stale = set(self._assets).difference(assets)
+        self._assets = sorted(assets)
+        self._asset_files = {source.describe(member) for source, member in assets.values()}
+        return [os.path.join(self._target, *relative_file.split("/")) for relative_file in sorted(stale)]
+
+    def forget(self, file):
+        self._targets.pop(self._relative(file), None)
+
+    def save(self):
+        # Only remember files that still contribute to something
+        described = {entry[1] for signature in self._targets.values() if signature is not None for entry in signature}
+        described.update(self._asset_files)
+        files = {description: value for description, value in self._files.items() if description in described}
+        manifest = {"version": self.version, "options": self.options, "files": files, "targets": self._targets,
+                    "assets": self._assets}
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.path)
+
+    def _relative(self, file):
+        return os.path.relpath(file, self._target).replace(os.sep, "/")
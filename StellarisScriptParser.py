@@ -0,0 +1,266 @@
+import bisect
+import re
+
+from model import SmoosherDataModel
+
+# Token kinds produced by our tokenizer
+_WORD = 1
+_QUOTED = 2
+_OPERATOR = 3
+_EQUALS = 4
+_OPEN = 5
+_CLOSE = 6
+_ORIGIN = 7
+_WHITESPACE = 8
+_INVALID = 9
+
+# Note the group order here must match the token kinds above as we use lastindex to identify them
+_TOKEN = re.compile(
+    r"((?:\+(?=\d))?[A-Za-z0-9\u00c0-\u00d6\u00d8-\u00f6\u00f8-\u00ff_\-.:?@\[\]]+)"  # Unquoted string or number
+    r"|(\"(?:[^\"\n\r\\]|(?:\"\")|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*\")"  # Quoted string
+    r"|([<>]=?)"  # Query operators
+    r"|(=)"
+    r"|(\{)"
+    r"|(\})"
+    r"|(#ORIGIN = )"
+    r"|([ \t\r\n]+)"
+    r"|(.)", re.DOTALL)
+
+# These mirror the value types (and their precedence) in the pyparsing grammar
+_REAL = re.compile(r"[+-]?\d+\.\d*")
+_INTEGER = re.compile(r"[+-]?\d+")
+_KEYWORD_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$")
+
+# Top level statements that open a block, used to resynchronise after an error. Files nearly always start these at the
+# beginning of a line so anything indented is assumed to be nested.
+_BOUNDARY = re.compile(r"^(?:\"[^\"\n]*\"|[^\s={}#\"<>]+)[ \t]*=[ \t]*{", re.MULTILINE)
+
+
+def find_next_statement(src, position):
+    match = _BOUNDARY.search(src, position + 1)
+    if match is None:
+        return len(src)
+
+    return match.start()
+
+
+# Everything that changes the brace depth, with quoted strings matched whole so that any braces within them are ignored
+_SCOPE = re.compile(r"(" + _BOUNDARY.pattern + r")|\"(?:[^\"\n\r\\]|\"\"|\\.)*\"|({)|(})", re.MULTILINE)
+
+
+def split_statements(src, chunk_size):
+    # Offsets splitting the source into runs of whole top level statements, each at least chunk_size characters long
+    # (bar the last). Statements are only split where a block opens at the beginning of a line outside of any other
+    # block. Returns None when the braces do not balance as we cannot be sure where statements end.
+    starts = [0]
+    depth = 0
+    for match in _SCOPE.finditer(src):
+        if match.lastindex == 1:
+            if depth == 0 and match.start() - starts[-1] >= chunk_size:
+                starts.append(match.start())
+            depth += 1
+        elif match.lastindex == 2:
+            depth += 1
+        elif match.lastindex == 3:
+            depth -= 1
+            if depth < 0:
+                return None
+
+    if depth != 0:
+        return None
+
+    return starts
+
+
+class StellarisParseError(Exception):
+    def __init__(self, message, src, position):
+        self.message = message
+        self.line = src.count("\n", 0, position) + 1
+        self.column = position - (src.rfind("\n", 0, position) + 1) + 1
+        self.position = position
+        super().__init__(message + " (at line: " + str(self.line) + ", column: " + str(self.column) + ")")
+
+
+# Single pass tokenizer and recursive descent parser for clausewitz script. This builds our data model directly and
+# should produce exactly the same model as the pyparsing grammar in StellarisDataParser - only much faster
+class StellarisScriptParser(object):
+    def parse(self, src, fallback_source, recover=False):
+        self._src = src
+        self._kinds, self._texts, self._positions = self._tokenize(src)
+        self._index = 0
+
+        document = SmoosherDataModel.Document(fallback_source, fallback_source)
+        if len(self._kinds) == 0:
+            self._error("Expected a statement")
+
+        # The root of the document may only contain assignments and blocks
+        while self._index < len(self._kinds):
+            if not recover:
+                self._parse_statement(document, document, fallback_source, True)
+                continue
+
+            # Statements are only added to their parent once complete, so failures leave the document untouched
+            start = self._positions[self._index]
+            try:
+                self._parse_statement(document, document, fallback_source, True)
+            except StellarisParseError as error:
+                document.add_diagnostic(SmoosherDataModel.Diagnostic(error.line, error.column, error.message))
+                resume = find_next_statement(src, start)
+                self._index = bisect.bisect_left(self._positions, resume)
+
+        return document
+
+    def _tokenize(self, src):
+        kinds = list()
+        texts = list()
+        positions = list()
+        for match in _TOKEN.finditer(src):
+            kind = match.lastindex
+            if kind == _WHITESPACE:
+                continue
+
+            kinds.append(kind)
+            texts.append(match.group())
+            positions.append(match.start())
+
+        return kinds, texts, positions
+
+    def _parse_statement(self, root_document, parent, fallback_source, is_root):
+        index = self._index
+        kinds = self._kinds
+        kind = kinds[index]
+        if kind != _WORD and kind != _QUOTED:
+            self._error("Expected a key or value")
+
+        following = kinds[index + 1] if index + 1 < len(kinds) else None
+        if following == _EQUALS or following == _OPERATOR:
+            # Only numbers may carry an explicit sign so this can never be a key
+            if self._texts[index][0] == "+":
+                self._error("Expected a key")
+
+        # Blocks & assignments
+        if following == _EQUALS:
+            key = self._texts[index]
+            self._index = index + 2
+            if self._index < len(kinds) and kinds[self._index] == _OPEN:
+                self._index += 1
+                node = self._parse_block(root_document, key, fallback_source)
+                parent.add_node(node)
+            else:
+                value = self._parse_value()
+                source = self._parse_origin(fallback_source)
+                parent.add_attribute(SmoosherDataModel.Attribute(root_document, key, "=", value, source))
+
+        elif is_root:
+            self._error("Expected an assignment or block")
+
+        # Queries
+        elif following == _OPERATOR:
+            key = self._texts[index]
+            operator = self._texts[index + 1]
+            self._index = index + 2
+            value = self._parse_value()
+            source = self._parse_origin(fallback_source)
+            parent.add_attribute(SmoosherDataModel.Attribute(root_document, key, operator, value, source))
+
+        # Lone values
+        else:
+            value = self._parse_value()
+            source = self._parse_origin(fallback_source)
+            parent.add_attribute(SmoosherDataModel.ListAttribute(root_document, value, source))
+
+    def _parse_block(self, root_document, key, fallback_source):
+        # Content has to be built before we know our origin, so hold on to it until then
+        content = SmoosherDataModel.Node(root_document, key, fallback_source)
+        kinds = self._kinds
+        while True:
+            if self._index >= len(kinds):
+                self._error("Expected '}'")
+
+            if kinds[self._index] == _CLOSE:
+                self._index += 1
+                break
+
+            self._parse_statement(root_document, content, fallback_source, False)
+
+        source = self._parse_origin(None)
+        if source is not None:
+            content.source = SmoosherDataModel.intern(source.replace(" ", "_"))
+
+        return content
+
+    def _parse_value(self):
+        index = self._index
+        if index >= len(self._kinds):
+            self._error("Expected a value")
+
+        kind = self._kinds[index]
+        text = self._texts[index]
+        if kind == _QUOTED:
+            self._index += 1
+            return text
+
+        if kind != _WORD:
+            self._error("Expected a value")
+
+        # Emulate the pyparsing match order, which may only consume part of an unquoted string
+        match = _REAL.match(text)
+        if match is not None:
+            return self._consume(float(match.group()), match.end())
+
+        match = _INTEGER.match(text)
+        if match is not None:
+            return self._consume(int(match.group()), match.end())
+
+        keyword = self._match_keyword(text)
+        if keyword is not None:
+            return self._consume(keyword, 3 if keyword else 2)
+
+        self._index += 1
+        return text
+
+    def _match_keyword(self, text):
+        # Keywords cannot be glued to a preceding or following keyword character
+        position = self._positions[self._index]
+        if position > 0 and self._src[position - 1].upper() in _KEYWORD_CHARS:
+            return None
+
+        for keyword, value in (("YES", True), ("NO", False)):
+            length = len(keyword)
+            if text[:length].upper() == keyword and (len(text) == length or text[length].upper() not in _KEYWORD_CHARS):
+                return value
+
+        return None
+
+    def _consume(self, value, length):
+        # Leave the remainder of a partially consumed unquoted string as the next token
+        text = self._texts[self._index]
+        if length == len(text):
+            self._index += 1
+        else:
+            self._texts[self._index] = text[length:]
+            self._positions[self._index] += length
+
+        return value
+
+    def _parse_origin(self, fallback_source):
+        index = self._index
+        kinds = self._kinds
+        if index < len(kinds) and kinds[index] == _ORIGIN:
+            if index + 1 < len(kinds) and (kinds[index + 1] == _WORD or kinds[index + 1] == _QUOTED):
+                self._index = index + 2
+                return self._texts[index + 1]
+
+            self._error("Expected an origin")
+
+        return fallback_source
+
+    def _error(self, message):
+        if self._index < len(self._positions):
+            position = self._positions[self._index]
+            if self._kinds[self._index] == _INVALID:
+                message = "Unexpected character: " + repr(self._texts[self._index])
+        else:
+            position = len(self._src)
+
+        raise StellarisParseError(message, self._src, position)
@@ -0,0 +1,106 @@
+import argparse
+import copy
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import StellarisDataParser
+import parser_throughput
+
+
+class original_dict_list(dict):
+    # dict_list as it was before it held single values inline, kept as it was to compare against
+    def __setitem__(self, key, value):
+        try:
+            self[key]
+        except KeyError:
+            super(original_dict_list, self).__setitem__(key, [])
+
+        if isinstance(value, list):
+            self[key].extend(value)
+        else:
+            self[key].append(value)
+
+    def __eq__(self, other):
+        if not isinstance(other, original_dict_list):
+            return False
+
+        if "value" in self and "value" in other:
+            return self["value"] == other["value"]
+
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        if not isinstance(other, original_dict_list):
+            return True
+
+        if "value" in self and "value" in other:
+            return self["value"] != other["value"]
+
+        return super().__ne__(other)
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+
+implementations = {"original": original_dict_list, "current": StellarisDataParser.dict_list}
+
+
+def measure(implementation, parser, models):
+    # Documents are derived through the module's dict_list, so swap in whichever we are measuring
+    current = StellarisDataParser.dict_list
+    StellarisDataParser.dict_list = implementations[implementation]
+    try:
+        start = time.perf_counter()
+        documents = [parser.derive_document(model) for model in models]
+        derived = time.perf_counter()
+        copies = [document.copy() for document in documents]
+        copied = time.perf_counter()
+        equal = all(document == document_copy for document, document_copy in zip(documents, copies))
+        compared = time.perf_counter()
+    finally:
+        StellarisDataParser.dict_list = current
+
+    if not equal:
+        print("Copies of " + implementation + " documents were not equal")
+
+    return derived - start, copied - derived, compared - copied
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Times building, copying and comparing dict_list documents")
+    argparser.add_argument("corpus", nargs="?", help="Directory of script files, a generated corpus is used otherwise")
+    argparser.add_argument("--files", type=int, default=100, help="Size of the generated corpus")
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as generated:
+        directory = args.corpus
+        if directory is None:
+            parser_throughput.generate_corpus(generated, args.files)
+            directory = generated
+
+        corpus = parser_throughput.load_corpus(directory)
+
+    parser = StellarisDataParser.StellarisDataParser(engine="native")
+    # Silence the per file progress
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        models = [parser.parse_model("benchmark", file, src) for file, src in corpus]
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    models = [model for model in models if model is not None]
+    print("Corpus: " + str(len(models)) + " files, " + str(sum(len(model.objects) for model in models)) + " holders")
+    print("{:<8} {:>9} {:>9} {:>9}".format("", "derive", "copy", "compare"))
+    for implementation in implementations:
+        timings = measure(implementation, parser, models)
+        print("{:<8} {:>8.3f}s {:>8.3f}s {:>8.3f}s".format(implementation, *timings))
+
+
+if __name__ == "__main__":
+    main()
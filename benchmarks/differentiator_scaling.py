@@ -0,0 +1,54 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model import SmoosherComparator
+from model import SmoosherDataModel
+
+differentiators = {"data": SmoosherComparator.DataDifferentiator, "tree": SmoosherComparator.TreeDifferentiator}
+
+
+def generate_document(leaves, edit_rate=0.0, seed=1):
+    # A single block of uniquely keyed leaves, a fraction of which have a different value
+    rng = random.Random(seed)
+    document = SmoosherDataModel.Document("benchmark", "benchmark")
+    block = SmoosherDataModel.Node(document, "big_block", "benchmark")
+    document.add_node(block)
+    for index in range(leaves):
+        value = -index if rng.random() < edit_rate else index
+        block.add_attribute(SmoosherDataModel.Attribute(document, "key_" + str(index), "=", value, "benchmark"))
+
+    return document
+
+
+def measure(differentiator, leaves, edit_rate):
+    original = generate_document(leaves)
+    latest = generate_document(leaves, edit_rate, seed=2)
+    start = time.perf_counter()
+    differ = differentiators[differentiator](original, latest)
+    differ.compare()
+    return time.perf_counter() - start, len(differ.original_changes)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Times comparing blocks of increasing numbers of leaves")
+    argparser.add_argument("--leaves", type=int, nargs="+", default=[1000, 10000, 100000])
+    argparser.add_argument("--edit-rate", type=float, default=0.1, help="Fraction of leaves given a different value")
+    argparser.add_argument("--differentiators", nargs="+", default=list(differentiators), choices=differentiators)
+    args = argparser.parse_args()
+
+    # Roughly constant time per leaf shows the matching is linear
+    print("{:<6} {:>8} {:>9} {:>8} {:>12}".format("", "leaves", "time", "changes", "us/leaf"))
+    for differentiator in args.differentiators:
+        for leaves in args.leaves:
+            elapsed, changes = measure(differentiator, leaves, args.edit_rate)
+            print("{:<6} {:>8} {:>8.3f}s {:>8} {:>12.2f}".format(differentiator, leaves, elapsed, changes,
+                                                                 elapsed / leaves * 1000000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import StellarisDataParser
+import parser_throughput
+
+
+def measure(engine, corpus):
+    # Everything allocated whilst parsing that is still held once the sources are gone, i.e. what the models cost
+    parser = StellarisDataParser.StellarisDataParser(engine=engine)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        models = [parser.parse_model("benchmark", file, src) for file, src in corpus]
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    models = [model for model in models if model is not None]
+    holders = sum(len(model.objects) - 1 for model in models)
+    return holders, retained - before, peak - before
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Measures how much memory parsed models take per holder")
+    argparser.add_argument("corpus", nargs="?", help="Directory of script files, a generated corpus is used otherwise")
+    argparser.add_argument("--files", type=int, default=100, help="Size of the generated corpus")
+    argparser.add_argument("--engines", nargs="+", default=StellarisDataParser.StellarisDataParser.engines,
+                           choices=StellarisDataParser.StellarisDataParser.engines)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as generated:
+        directory = args.corpus
+        if directory is None:
+            parser_throughput.generate_corpus(generated, args.files)
+            directory = generated
+
+        corpus = parser_throughput.load_corpus(directory)
+
+    size = sum(len(src) for file, src in corpus)
+    print("Corpus: " + str(len(corpus)) + " files, " + str(size // 1024) + " KiB")
+
+    # Each engine is measured in a fresh process so that neither benefits from what the other interned
+    context = multiprocessing.get_context("spawn")
+    for engine in args.engines:
+        with context.Pool(1) as pool:
+            holders, retained, peak = pool.apply(measure, (engine, corpus))
+
+        print("{:<10} {:>9} holders {:>8.1f} MiB retained {:>8.1f} MiB peak {:>8.1f} bytes/holder".format(
+            engine, holders, retained / (1024 * 1024), peak / (1024 * 1024), retained / holders))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import StellarisDataParser
+
+# How each configuration builds its parser. Every configuration runs in a fresh process as packrat is enabled globally.
+configurations = ["rebuild", "reuse", "packrat", "native"]
+
+
+def generate_corpus(directory, count, seed=1):
+    # A fixed, representative corpus for when there is no game or mod directory to hand
+    rng = random.Random(seed)
+    for index in range(count):
+        lines = list()
+        for block in range(rng.randint(20, 120)):
+            lines.append("item_" + str(index) + "_" + str(block) + " = {")
+            _generate_content(rng, lines, 1)
+            lines.append("}")
+
+        with open(os.path.join(directory, "file_" + str(index) + ".txt"), "w") as corpus_file:
+            corpus_file.write("# Generated benchmark file\n" + "\n".join(lines) + "\n")
+
+
+def _generate_content(rng, lines, depth):
+    tabs = "\t" * depth
+    for statement in range(rng.randint(2, 8)):
+        kind = rng.random()
+        if kind < 0.25 and depth < 4:
+            lines.append(tabs + rng.choice(["potential", "allow", "modifier", "ai_weight", "trigger"]) + " = {")
+            _generate_content(rng, lines, depth + 1)
+            lines.append(tabs + "}")
+        elif kind < 0.35:
+            lines.append(tabs + "num_pops > " + str(rng.randint(0, 50)))
+        elif kind < 0.45:
+            lines.append(tabs + "name = \"" + rng.choice(["Alpha", "Beta Prime", "Gamma"]) + "\" # comment")
+        else:
+            value = rng.choice([str(rng.randint(-100, 100)), str(round(rng.uniform(0, 5), 2)), "yes", "no",
+                                "value_" + str(rng.randint(0, 9))])
+            lines.append(tabs + "key_" + str(rng.randint(0, 20)) + " = " + value)
+
+
+def load_corpus(directory):
+    corpus = list()
+    for root, nested, files in os.walk(directory):
+        for file in sorted(files):
+            if file.endswith(".txt"):
+                with open(os.path.join(root, file), "r", encoding="utf-8-sig", errors="replace") as corpus_file:
+                    corpus.append((file, corpus_file.read()))
+
+    return corpus
+
+
+def measure(configuration, corpus):
+    if configuration == "native":
+        parser = StellarisDataParser.StellarisDataParser(engine="native")
+    else:
+        parser = StellarisDataParser.StellarisDataParser(packrat=configuration == "packrat")
+
+    # Silence the per file progress
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.perf_counter()
+        for file, src in corpus:
+            if configuration == "rebuild":
+                parser._grammar = StellarisDataParser.StellarisGrammar()  # As every parse used to
+            parser.parse_model("benchmark", file, src)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    return elapsed
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Measures parser throughput in files per second")
+    argparser.add_argument("corpus", nargs="?", help="Directory of script files, a generated corpus is used otherwise")
+    argparser.add_argument("--files", type=int, default=100, help="Size of the generated corpus")
+    argparser.add_argument("--configurations", nargs="+", default=configurations, choices=configurations)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as generated:
+        directory = args.corpus
+        if directory is None:
+            generate_corpus(generated, args.files)
+            directory = generated
+
+        corpus = load_corpus(directory)
+
+    size = sum(len(src) for file, src in corpus)
+    print("Corpus: " + str(len(corpus)) + " files, " + str(size // 1024) + " KiB")
+    context = multiprocessing.get_context("spawn")
+    for configuration in args.configurations:
+        with context.Pool(1) as pool:
+            elapsed = pool.apply(measure, (configuration, corpus))
+
+        print("{:<8} {:>8.2f}s {:>10.1f} files/s".format(configuration, elapsed, len(corpus) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
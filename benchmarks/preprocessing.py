@@ -0,0 +1,71 @@
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import StellarisDataParser
+import parser_throughput
+
+
+def original_pre_process_source(src):
+    # The seven passes _pre_process_source used to make, kept as they were to compare against
+    src = re.sub(r"^dependencies={[^}]*}$", "", src, flags=re.MULTILINE)
+    src = re.sub(r"^tags={[^}]*}$", "", src, flags=re.MULTILINE)
+    src = re.sub(r"#((?!ORIGIN).)*$", "", src, flags=re.MULTILINE)
+    src = re.sub(r"([A-Za-z0-9_.\-]+){", r"\1={", src)
+    src = re.sub(r"\"([A-Za-z0-9_.\-]+)\"\s*=", r"\1=", src, 0, re.MULTILINE)
+    src = re.sub(r"=\s*{", r"={", src, 0, re.MULTILINE)
+    src = re.sub(r"^\s*{\s*\}", r"", src, 0, re.MULTILINE)
+    return src
+
+
+def measure(pre_process, corpus, repeats):
+    # Best of several runs, as these are short enough for noise to matter
+    best = None
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        for file, src in corpus:
+            pre_process(src)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Times source preprocessing over the largest files of a corpus")
+    argparser.add_argument("corpus", nargs="?", help="Directory of script files, a generated corpus is used otherwise")
+    argparser.add_argument("--files", type=int, default=100, help="Size of the generated corpus")
+    argparser.add_argument("--largest", type=int, default=10, help="Number of files to time")
+    argparser.add_argument("--repeats", type=int, default=5)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as generated:
+        directory = args.corpus
+        if directory is None:
+            parser_throughput.generate_corpus(generated, args.files)
+            directory = generated
+
+        corpus = parser_throughput.load_corpus(directory)
+
+    corpus = sorted(corpus, key=lambda item: len(item[1]), reverse=True)[:args.largest]
+    size = sum(len(src) for file, src in corpus)
+    print("Largest " + str(len(corpus)) + " files, " + str(size // 1024) + " KiB")
+
+    parser = StellarisDataParser.StellarisDataParser(engine="native")
+    for file, src in corpus:
+        if parser._pre_process_source(src) != original_pre_process_source(src):
+            print("Output differs for: " + file)
+
+    timings = [("original", original_pre_process_source), ("current", parser._pre_process_source)]
+    for name, pre_process in timings:
+        elapsed = measure(pre_process, corpus, args.repeats)
+        print("{:<8} {:>8.3f}s {:>10.1f} MiB/s".format(name, elapsed, size / elapsed / (1024 * 1024)))
+
+
+if __name__ == "__main__":
+    main()
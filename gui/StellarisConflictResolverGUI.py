@@ -115,10 +115,12 @@ class StellarislatestResolver(tk.Frame):
         self.original_text.tag_configure("add", background="green")
         self.original_text.tag_configure("del", background="red")
         self.original_text.tag_configure("edit", background="yellow")
+        self.original_text.tag_configure("move", background="orange")
         self.original_text.tag_configure("highlight", background="blue")
         self.latest_text.tag_configure("add", background="green")
         self.latest_text.tag_configure("del", background="red")
         self.latest_text.tag_configure("edit", background="yellow")
+        self.latest_text.tag_configure("move", background="orange")
         self.latest_text.tag_configure("highlight", background="blue")
 
     def left(self):
@@ -213,6 +215,9 @@ class StellarislatestResolver(tk.Frame):
                 elif isinstance(diff, SmoosherComparator.Change):
                     destination.tag_add("edit", start_pos, end_pos)
 
+                elif isinstance(diff, SmoosherComparator.Move):
+                    destination.tag_add("move", start_pos, end_pos)
+
                 if diff in self.diff_markers_dict:
                     if is_original:
                         diff_marker = self.diff_markers_dict[diff]
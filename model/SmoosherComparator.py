@@ -1,3 +1,9 @@
+import bisect
+from array import array
+
+from model import SmoosherDataModel
+
+
 class Difference:
     def __init__(self, type, original, latest):
         self.type = type
@@ -20,6 +26,11 @@ class Change(Difference):
         super().__init__("change", original, latest)
 
 
+class Move(Difference):
+    def __init__(self, original, latest):
+        super().__init__("move", original, latest)
+
+
 class DataDifferentiator:
     def __init__(self, original, latest):
         self.original = original
@@ -31,92 +42,184 @@ class DataDifferentiator:
         return len(self.original_changes) + len(self.latest_changes)
 
     def compare(self):
-        # Quick and eminently defeatable check to validate if our docs have been pruned ahead of time
-        if not self.original.is_pruned:
-            self.original.prune_children()
-
-        if not self.latest.is_pruned:
-            self.latest.prune_children()
-
         # Compare our attribute - this is easy as we can use the key for identity
         original_attributes = self.original.attributes.copy()
-        latest_attributes = self.latest.attributes.copy()
+        latest_attributes = self.latest.attributes
+        key_buckets = self._bucket(latest_attributes, self._by_key)
         while len(original_attributes) > 0:
             original_attribute = original_attributes.pop()
-            found = False
-            for latest_attribute in latest_attributes:
 
-                # Check if the key is the same if so we can either register a change or its the same
-                if original_attribute.key == latest_attribute.key:
-                    if not original_attributes.equals(latest_attribute):
-                        self._register_difference(Change(original_attribute, latest_attribute))
+            # Check if the key is the same if so we can either register a change or its the same
+            bucket = key_buckets.get(original_attribute.key)
+            if bucket:
+                latest_attribute = self._first(bucket)
+                if not original_attribute.equals(latest_attribute):
+                    self._register_difference(Change(original_attribute, latest_attribute))
 
-                    latest_attributes.remove(latest_attribute)  # Safe as we break out of loop
-                    found = True
-                    break
+                del bucket[latest_attribute.unique_id]
 
             # If it wasn't found then we need to assign it as a deletion
-            if not found:
+            else:
                 self._register_difference(Deletion(original_attribute))
 
         # Any remaining in latest_attributes are new
-        for latest_attribute in latest_attributes:
+        for latest_attribute in self._unclaimed(latest_attributes, key_buckets, self._by_key):
             self._register_difference(Addition(latest_attribute))
 
         # Cheeky assumption: Root node (not doc) == identity of branch. We also assume that key is sufficiently unique -
         # normally this would not be true, but we special case for situations where it's not Note its only going to
         # be true for a root node
-        for node in self.original:
-
-            # Lets obtain the leaves
-            # Now evaluate leafs on both (or do this automatically when constructing the tree)
-            original_leaves = node.get_leaves().copy()
-            latest_leaves = node.get_leaves().copy()
-
-            # Work through each of the original leaves until we have none left
-            while len(original_leaves) > 0:
-                original_leaf = original_leaves.pop()
-                found = False
-                potential_matches = list()
-                latest_leaf = None
-
-                # Side by side comparison to latest leaves
-                for latest_leaf in latest_leaves:
-
-                    # Assess whether the leaves are the same - note leaves may not be unique
-                    if original_leaf.key == latest_leaf.key:
-
-                        # In this scenario we can assume identity - it may be a false assumption but its not a bad one
-                        if original_leaf.get_branch_path() == latest_leaf.get_branch_path():
-                            found = True
-
-                        # Otherwise we should store the candidates
-                        potential_matches.append(latest_leaf)
-
-                # This leaf has a one to one match
-                if found:
-
-                    # Evaluate if there is a change to register
-                    if not original_leaf.equals(latest_leaf):
-                        self._register_difference(Change(original_leaf, latest_leaf))
-
-                    latest_leaves.remove()  # Safe as we break out of loop
-
-                # If we have no matches then we can assume its a deletion
-                if len(potential_matches) == 0:
-                    self._register_difference(Deletion(original_leaf))
+        original_nodes, latest_nodes = self._cancel_identical(self.original.children, self.latest.children)
+        for original_node, latest_node in self._pair_by_key(original_nodes, latest_nodes):
+            if original_node is None:
+                self._register_difference(Addition(latest_node))
+
+            elif latest_node is None:
+                self._register_difference(Deletion(original_node))
+
+            else:
+                self._compare_leaves(original_node, latest_node)
+
+    def _compare_leaves(self, original_node, latest_node):
+        # Lets obtain the leaves that actually differ
+        original_leaves = list()
+        latest_leaves = list()
+        self._collect_divergent_leaves(original_node, latest_node, original_leaves, latest_leaves)
+
+        # Leaves sharing a key and branch path are assumed to be the same leaf, whereas leaves only sharing a key are
+        # candidates for having been moved. Note leaves may not be unique.
+        path_buckets = self._bucket(latest_leaves, self._by_path)
+        key_buckets = self._bucket(latest_leaves, self._by_key)
+
+        # Work through each of the original leaves until we have none left
+        while len(original_leaves) > 0:
+            original_leaf = original_leaves.pop()
+            potential_matches = key_buckets.get(original_leaf.key)
+
+            # In this scenario we can assume identity - it may be a false assumption but its not a bad one
+            identical_matches = path_buckets.get(self._by_path(original_leaf))
+            if identical_matches:
+                match = self._first(identical_matches)
+
+                # Evaluate if there is a change to register
+                if not original_leaf.equals(match):
+                    self._register_difference(Change(original_leaf, match))
+
+                self._claim(match, identical_matches, potential_matches)
+
+            # If we have no matches then we can assume its a deletion
+            elif not potential_matches:
+                self._register_difference(Deletion(original_leaf))
 
-                # One fuzzy match means we could assume its been moved
-                elif len(potential_matches) == 1:
-                    self._register_difference(Change(original_leaf, latest_leaf))
-                    latest_leaves.remove(latest_leaf)  # Safe as we break out of loop
+            # One fuzzy match means we could assume its been moved
+            elif len(potential_matches) == 1:
+                match = self._first(potential_matches)
+                self._register_difference(Change(original_leaf, match))
+                self._claim(match, path_buckets[self._by_path(match)], potential_matches)
 
-                # Otherwise we should assume this is a deletion rather than attempting to calculate reassignments
+            # Otherwise we should assume this is a deletion rather than attempting to calculate reassignments
+            else:
                 self._register_difference(Deletion(original_leaf))
 
-            # All remaining leaves in the latest list can be assigned as additions
-            for leaf in latest_leaves:
-                self._register_difference(Addition(leaf))
+        # All remaining leaves in the latest list can be assigned as additions
+        for leaf in self._unclaimed(latest_leaves, key_buckets, self._by_key):
+            self._register_difference(Addition(leaf))
+
+    @staticmethod
+    def _by_key(holder):
+        return holder.key
+
+    @staticmethod
+    def _by_hash(holder):
+        return holder.structural_hash()
+
+    @staticmethod
+    def _by_path(holder):
+        return holder.key, holder.get_branch_path()
+
+    @staticmethod
+    def _bucket(holders, identity):
+        # Buckets are insertion ordered dicts of unique id -> holder so the first unclaimed holder in document order
+        # can be found, and a holder claimed, in O(1)
+        buckets = dict()
+        for holder in holders:
+            bucket = buckets.get(identity(holder))
+            if bucket is None:
+                buckets[identity(holder)] = {holder.unique_id: holder}
+            else:
+                bucket[holder.unique_id] = holder
+
+        return buckets
+
+    @staticmethod
+    def _first(bucket):
+        return next(iter(bucket.values()))
+
+    @staticmethod
+    def _claim(holder, *buckets):
+        for bucket in buckets:
+            del bucket[holder.unique_id]
+
+    @staticmethod
+    def _unclaimed(holders, buckets, identity):
+        return [holder for holder in holders if holder.unique_id in buckets[identity(holder)]]
+
+    def _collect_divergent_leaves(self, original_node, latest_node, original_leaves, latest_leaves):
+        # Identical attributes and subtrees on both sides cancel out using their structural hashes so we only ever
+        # descend into the parts of the tree that differ
+        original_attributes, latest_attributes = self._cancel_identical(original_node.attributes,
+                                                                        latest_node.attributes)
+        original_leaves.extend(original_attributes)
+        latest_leaves.extend(latest_attributes)
+
+        original_children, latest_children = self._cancel_identical(original_node.children, latest_node.children)
+        for original_child, latest_child in self._pair_by_key(original_children, latest_children):
+            if latest_child is None:
+                self._extend_leaves(original_child, original_leaves)
+
+            elif original_child is None:
+                self._extend_leaves(latest_child, latest_leaves)
+
+            else:
+                self._collect_divergent_leaves(original_child, latest_child, original_leaves, latest_leaves)
+
+    def _extend_leaves(self, node, leaves):
+        # Empty blocks have no leaves so stand in for themselves
+        node_leaves = node.get_leaves()
+        if len(node_leaves) == 0:
+            leaves.append(node)
+        else:
+            leaves.extend(node_leaves)
+
+    def _cancel_identical(self, originals, latests):
+        buckets = self._bucket(latests, self._by_hash)
+        remaining_originals = list()
+        for original in originals:
+            bucket = buckets.get(original.structural_hash())
+            if bucket:
+                self._claim(next(reversed(bucket.values())), bucket)  # Identical so any will do
+            else:
+                remaining_originals.append(original)
+
+        return remaining_originals, self._unclaimed(latests, buckets, self._by_hash)
+
+    def _pair_by_key(self, originals, latests):
+        # Pair up holders sharing a key in order, anything left without a partner is returned alongside None
+        buckets = self._bucket(latests, self._by_key)
+        pairs = list()
+        for original in originals:
+            bucket = buckets.get(original.key)
+            if bucket:
+                latest = self._first(bucket)
+                self._claim(latest, bucket)
+                pairs.append((original, latest))
+            else:
+                pairs.append((original, None))
+
+        for latest in self._unclaimed(latests, buckets, self._by_key):
+            pairs.append((None, latest))
+
+        return pairs
 
     def _register_difference(self, difference):
         # Store the relevant ids of where the diff is - specifically where the divergence originates in the tree by
@@ -136,3 +239,293 @@ class DataDifferentiator:
             self.original_changes[original_real_id] = difference
             latest_real_id = difference.latest.compute_branch_point_successor()
             self.latest_changes[latest_real_id] = difference
+
+
+class TreeDifferentiator(DataDifferentiator):
+    # Ordered tree diff in the style of GumTree. Identical blocks are anchored top down by their structural hashes, the
+    # remaining blocks are matched bottom up by how many of their descendants already match and anything left over is
+    # matched within its matched parent. The mapping is then turned into a minimal edit script including moves, where
+    # additions and deletions are only recorded for the root of the subtree that was added or deleted.
+    max_candidates = 64  # Bounds the search for where an identical block has stayed put
+    min_dice = 0.5  # Proportion of matching descendants required to pair two blocks bottom up
+
+    def __init__(self, original, latest):
+        super().__init__(original, latest)
+        self._original_tree = _NumberedTree(original)
+        self._latest_tree = _NumberedTree(latest)
+        self._original_partners = array("l", [-1]) * len(original.objects)  # Original id -> latest id
+        self._latest_partners = array("l", [-1]) * len(latest.objects)  # Latest id -> original id
+
+    def compare(self):
+        self._match(self.original, self.latest)
+        self._match_anchors()
+        self._match_bottom_up()
+        self._match_leftovers()
+        self._match_moved_leaves()
+        self._generate_edit_script()
+
+    def _partner(self, original):
+        partner = self._original_partners[original.unique_id]
+        return None if partner < 0 else self.latest.objects[partner]
+
+    def _is_matched(self, holder, partners):
+        return partners[holder.unique_id] >= 0
+
+    def _match(self, original, latest):
+        self._original_partners[original.unique_id] = latest.unique_id
+        self._latest_partners[latest.unique_id] = original.unique_id
+
+    def _match_subtree(self, original, latest):
+        # Identical subtrees have identical shapes so their pre orders line up
+        for original_holder, latest_holder in zip(self._original_tree.subtree(original),
+                                                  self._latest_tree.subtree(latest)):
+            self._match(original_holder, latest_holder)
+
+    def _match_anchors(self):
+        buckets = dict()
+        for holder in self._latest_tree.order:
+            if isinstance(holder, SmoosherDataModel.Node) and holder is not self.latest:
+                buckets.setdefault(holder.structural_hash(), dict())[holder.unique_id] = holder
+
+        # Leaves are too common to anchor on, they are paired up within their matched parents later on. Blocks are
+        # visited top down so the largest identical subtrees anchor first.
+        pending = list(reversed(self.original.children))
+        while len(pending) > 0:
+            node = pending.pop()
+            bucket = buckets.get(node.structural_hash())
+            if not bucket:
+                pending.extend(reversed(node.children))
+                continue
+
+            # Prefer a candidate that has stayed put
+            branch_path = node.get_branch_path()
+            candidate = None
+            for index, latest in enumerate(bucket.values()):
+                if candidate is None or latest.get_branch_path() == branch_path:
+                    candidate = latest
+
+                if index == self.max_candidates or candidate.get_branch_path() == branch_path:
+                    break
+
+            self._match_subtree(node, candidate)
+            for holder in self._latest_tree.subtree(candidate):
+                if isinstance(holder, SmoosherDataModel.Node):
+                    buckets[holder.structural_hash()].pop(holder.unique_id, None)
+
+    def _match_bottom_up(self):
+        # Candidates for a block are the unmatched blocks with the same key that contain wherever its matched
+        # descendants ended up, GumTree style. Walking up from each partner counts exactly how many descendants every
+        # candidate shares with us, without having to search every block with the same key.
+        latest_objects = self.latest.objects
+        latest_parents = self.latest.parents
+        latest_partners = self._latest_partners
+
+        # Reversed pre order visits descendants before their ancestors
+        for node in reversed(self._original_tree.order):
+            if not isinstance(node, SmoosherDataModel.Node) or self._is_matched(node, self._original_partners):
+                continue
+
+            common = dict()
+            for holder in self._original_tree.subtree(node):
+                ancestor = self._original_partners[holder.unique_id]
+                if ancestor < 0:
+                    continue
+
+                ancestor = latest_parents[ancestor]
+                while ancestor > 0:  # The document itself is always matched
+                    if latest_partners[ancestor] < 0 and latest_objects[ancestor].key == node.key:
+                        common[ancestor] = common.get(ancestor, 0) + 1
+                    ancestor = latest_parents[ancestor]
+
+            best = None
+            best_dice = self.min_dice
+            original_size = self._original_tree.size(node) - 1
+            for candidate, count in common.items():
+                candidate = latest_objects[candidate]
+                dice = 2.0 * count / (original_size + self._latest_tree.size(candidate) - 1)
+                if dice < best_dice or (dice == best_dice and best is not None and
+                                        not self._latest_tree.precedes(candidate, best)):
+                    continue  # Ties go to whichever comes first
+
+                best = candidate
+                best_dice = dice
+
+            if best is not None:
+                self._match(node, best)
+
+    def _match_leftovers(self):
+        # Pre order means parents are always finished before we look at their children
+        for original in self._original_tree.order:
+            if not isinstance(original, SmoosherDataModel.Node):
+                continue
+
+            latest = self._partner(original)
+            if latest is None:
+                continue
+
+            # Identical content first, then blocks carrying the same id (events etc.) and finally the same key
+            # (attributes with attributes and blocks with blocks)
+            for originals, latests in ((original.attributes, latest.attributes), (original.children, latest.children)):
+                originals = [holder for holder in originals if not self._is_matched(holder, self._original_partners)]
+                latests = [holder for holder in latests if not self._is_matched(holder, self._latest_partners)]
+                for identity in (self._by_hash, self._by_id, self._by_key):
+                    buckets = self._bucket(latests, identity)
+                    remaining = list()
+                    for holder in originals:
+                        bucket = buckets.get(identity(holder))
+                        if not bucket or identity(holder) is None:
+                            remaining.append(holder)
+                            continue
+
+                        partner = self._first(bucket)
+                        self._claim(partner, bucket)
+                        if holder.equals(partner):
+                            self._match_subtree(holder, partner)
+                        else:
+                            self._match(holder, partner)
+
+                    originals = remaining
+                    latests = self._unclaimed(latests, buckets, identity)
+
+    @staticmethod
+    def _by_id(holder):
+        # As SmoosherMerger identifies blocks. Anything without an id has no identity here.
+        if not isinstance(holder, SmoosherDataModel.Node):
+            return None
+
+        id_attribute = holder.find_attribute("id")
+        if id_attribute is None:
+            return None
+
+        return holder.key, SmoosherDataModel.correct_value(id_attribute.value)
+
+    def _match_moved_leaves(self):
+        # Leaves that are unique on both sides can be safely identified as having moved elsewhere
+        originals = dict()
+        for holder in self._original_tree.order:
+            if isinstance(holder, SmoosherDataModel.Leaf) and not self._is_matched(holder, self._original_partners):
+                originals.setdefault(holder.structural_hash(), list()).append(holder)
+
+        latests = dict()
+        for holder in self._latest_tree.order:
+            if isinstance(holder, SmoosherDataModel.Leaf) and not self._is_matched(holder, self._latest_partners):
+                latests.setdefault(holder.structural_hash(), list()).append(holder)
+
+        for digest, holders in originals.items():
+            partners = latests.get(digest)
+            if len(holders) == 1 and partners is not None and len(partners) == 1:
+                self._match(holders[0], partners[0])
+
+    def _generate_edit_script(self):
+        recorded = set()
+        latest_objects = self.latest.objects
+        for original in self._original_tree.order:
+            if original is self.original:
+                continue
+
+            latest = self._partner(original)
+            if latest is None:
+                # Only the root of a deleted subtree needs recording
+                if self._is_matched(original.parent, self._original_partners):
+                    self._register_difference(Deletion(original))
+
+                continue
+
+            if isinstance(original, SmoosherDataModel.Leaf) and not original.equals(latest):
+                self._register_difference(Change(original, latest))
+                recorded.add(original.unique_id)
+
+            elif self._original_partners[original.parent.unique_id] != latest.parent.unique_id:
+                self._register_difference(Move(original, latest))
+                recorded.add(original.unique_id)
+
+        for latest in self._latest_tree.order:
+            if latest is not self.latest and not self._is_matched(latest, self._latest_partners) and \
+                    self._is_matched(latest.parent, self._latest_partners):
+                self._register_difference(Addition(latest))
+
+        # Anything matched within the same parent but out of order has been moved. The longest run that is still in
+        # order stays put.
+        for original in self._original_tree.order:
+            if not isinstance(original, SmoosherDataModel.Node):
+                continue
+
+            latest = self._partner(original)
+            if latest is None or original.equals(latest):
+                continue
+
+            for originals, latests in ((original.attributes, latest.attributes), (original.children, latest.children)):
+                positions = {holder.unique_id: index for index, holder in enumerate(latests)}
+                in_place = list()
+                for holder in originals:
+                    partner = self._original_partners[holder.unique_id]
+                    if partner in positions:
+                        in_place.append((positions[partner], holder))
+
+                for position, holder in _out_of_order(in_place):
+                    if holder.unique_id not in recorded:
+                        partner = latest_objects[self._original_partners[holder.unique_id]]
+                        self._register_difference(Move(holder, partner))
+                        recorded.add(holder.unique_id)
+
+
+def _out_of_order(sequence):
+    # Everything not part of the longest increasing subsequence of positions, in O(n log n)
+    tails = list()
+    tail_indices = list()
+    previous = [-1] * len(sequence)
+    for index, (position, holder) in enumerate(sequence):
+        insert = bisect.bisect_left(tails, position)
+        if insert == len(tails):
+            tails.append(position)
+            tail_indices.append(index)
+        else:
+            tails[insert] = position
+            tail_indices[insert] = index
+
+        previous[index] = tail_indices[insert - 1] if insert > 0 else -1
+
+    in_order = set()
+    index = tail_indices[-1] if len(tail_indices) > 0 else -1
+    while index >= 0:
+        in_order.add(index)
+        index = previous[index]
+
+    return [item for index, item in enumerate(sequence) if index not in in_order]
+
+
+class _NumberedTree:
+    # Pre order numbering of a document so subtrees are contiguous slices and ancestry checks are O(1)
+    __slots__ = ("order", "starts", "ends")
+
+    def __init__(self, document):
+        self.order = list()
+        self.starts = array("l", [-1]) * len(document.objects)
+        self.ends = array("l", [-1]) * len(document.objects)
+        self._number(document)
+
+    def _number(self, node):
+        order = self.order
+        self.starts[node.unique_id] = len(order)
+        order.append(node)
+        for attribute in node.attributes:
+            self.starts[attribute.unique_id] = len(order)
+            order.append(attribute)
+            self.ends[attribute.unique_id] = len(order)
+
+        for child in node.children:
+            self._number(child)
+
+        self.ends[node.unique_id] = len(order)
+
+    def subtree(self, holder):
+        return self.order[self.starts[holder.unique_id]:self.ends[holder.unique_id]]
+
+    def size(self, holder):
+        return self.ends[holder.unique_id] - self.starts[holder.unique_id]
+
+    def precedes(self, holder, other):
+        return self.starts[holder.unique_id] < self.starts[other.unique_id]
+
+    def contains(self, ancestor, holder):
+        return self.starts[ancestor.unique_id] < self.starts[holder.unique_id] < self.ends[ancestor.unique_id]
@@ -1,3 +1,16 @@
+import hashlib
+import sys
+from array import array
+
+
+def intern(value):
+    # Keys, sources and common values repeat heavily across a load order so share a single copy of each
+    if type(value) is str:
+        return sys.intern(value)
+
+    return value
+
+
 def correct_value(value):
     if isinstance(value, list):
         value = value[0]
@@ -13,89 +26,183 @@ def correct_value(value):
     return string_value
 
 
+_indents = ["    " * depth for depth in range(32)]
+
+
+def indent(depth):
+    while depth >= len(_indents):
+        _indents.append("    " * len(_indents))
+
+    return _indents[depth]
+
+
+class TextEmitter:
+    # Produces the text for a tree as a series of chunks, either streamed into a writer or joined once into a string
+    flush_size = 2048  # Lines buffered before handing them over to our writer
+
+    def __init__(self, write=None):
+        self._write = write
+        self._lines = list()
+
+    def emit(self, holder, depth):
+        if isinstance(holder, Leaf):
+            self._lines.append(holder.to_line(depth))
+        elif isinstance(holder, Document):
+            self._emit_content(holder, depth)
+        else:
+            self._emit_node(holder, depth)
+
+        return self
+
+    def _emit_node(self, node, depth):
+        lines = self._lines
+        lines.append(node.write_header_to_text(depth))
+        self._emit_content(node, depth + 1)
+        lines.append(node.write_footer_to_text(depth))
+
+    def _emit_content(self, node, depth):
+        lines = self._lines
+        for attribute in node.attributes:
+            lines.append(attribute.to_line(depth))
+
+        for child in node.children:
+            self._emit_node(child, depth)
+
+        if self._write is not None and len(lines) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._lines) > 0:
+            self._write("".join(self._lines))
+            self._lines = list()
+
+    def text(self):
+        return "".join(self._lines)
+
+
+# The model classes below are slotted as a full load order produces millions of them. Any new state needs declaring in
+# __slots__ (and a bump to StellarisDataParser.PARSER_VERSION so that cached models are rebuilt).
 class MetadataHolder:
+    __slots__ = ("root_graph", "unique_id", "key", "assignee", "source", "parent", "_hash")
+
     def __init__(self, root, key, assignee, source):
         self.root_graph = root
-        self.unique_id = self.root_graph.unique_id(self)
-        self.key = key
-        self.assignee = assignee
-        self.source = source.replace(" ", "_")
+        self.unique_id = self.root_graph.allocate_id(self)
+        self.key = intern(key)
+        self.assignee = intern(assignee)
+        self.source = intern(source.replace(" ", "_"))
         self.parent = None
+        self._hash = None
 
     def set_parent(self, parent):
         self.parent = parent
+        self.root_graph.parents[self.unique_id] = -1 if parent is None else parent.unique_id
+        self.root_graph.tree_index = None  # Our shape has changed
 
+    def structural_hash(self):
+        # Digest of our content ignoring where it came from. Identical digests mean identical subtrees.
+        if self._hash is None:
+            self._hash = self._compute_hash()
 
-class Leaf(MetadataHolder):
-    def __init__(self, root, key, source):
-        super().__init__(root, key, key, source)
+        return self._hash
+
+    def invalidate_hash(self):
+        # A holder's digest can only be cached if all of its children's are, so we can stop at the first uncached one
+        holder = self
+        while holder is not None and holder._hash is not None:
+            holder._hash = None
+            holder = holder.parent
 
-    def equals(self, query_attribute):
-        exit(1)
+    def _compute_hash(self):
         pass
 
-    def get_branch_path(self):
-        exit(1)
+    def clone(self, root):
+        # Deep copy of this holder (keeping its sources) registered with the given document
+        holder = self._clone(root)
+        holder._hash = self._hash
+        return holder
+
+    def _clone(self, root):
         pass
 
+    def equals(self, query_holder):
+        return self.structural_hash() == query_holder.structural_hash()
+
+    def get_branch_path(self):
+        path = self.root_graph.get_tree_index().branch_paths[self.unique_id]
+        if path is None:  # Not attached to the document
+            return () if self.parent is None else self.root_graph.get_path(self.parent.unique_id)
+
+        return path
+
     def compute_branch_point_successor(self):
-        # Travese rootwards to identify the branching point and return the id
-        found = False
-        holder = self.parent
-        first_trunk = None
-        while not found:
-            found = holder.is_branch_point()
-            if not found:
-                first_trunk = holder
-                holder = first_trunk.traverse_rootwards()
-
-                if holder is None:
-                    print("Could not find a branch point up to root")
-                    exit(1)
-
-        return first_trunk.unique_id
+        # The holder just beneath the branching point rootwards of us
+        return self.root_graph.get_tree_index().branch_successors[self.unique_id]
+
+
+class Leaf(MetadataHolder):
+    __slots__ = ()
+
+    def __init__(self, root, key, source):
+        super().__init__(root, key, key, source)
+
+    def write(self, file_handle, tab_count):
+        file_handle.write(self.to_line(tab_count))
 
     def write_to_text(self, tab_count):
+        return self.to_line(tab_count)[:-1]
+
+    def to_line(self, tab_count):
         pass
 
 
 class Attribute(Leaf):
+    __slots__ = ("type", "value")
+
     def __init__(self, root, assignee, type, value, source):
         super().__init__(root, assignee, source)
-        self.assignee = assignee
-        self.type = type
-        self.value = value
+        self.type = intern(type)
+        self.value = intern(value)
 
     def __repr__(self):
         return "Assignment: " + self.assignee + " " + self.type + " " + str(self.value)
 
-    def write(self, file_handle, tab_count):
-        tabs = "    " * tab_count
-        file_handle.write(tabs + self.assignee + " " + self.type + " " + correct_value(
-            self.value) + " #ORIGIN = " + self.source + "\n")
+    def set_value(self, value):
+        self.value = intern(value)
+        self.invalidate_hash()
 
-    def write_to_text(self, tab_count):
-        tabs = "    " * tab_count
-        return tabs + self.assignee + " " + self.type + " " + correct_value(self.value) + " #ORIGIN = " + self.source
+    def _compute_hash(self):
+        return _digest(b"A", (self.assignee, self.type, correct_value(self.value)))
+
+    def _clone(self, root):
+        return Attribute(root, self.assignee, self.type, self.value, self.source)
+
+    def to_line(self, tab_count):
+        return indent(tab_count) + self.assignee + " " + self.type + " " + correct_value(self.value) + " #ORIGIN = " + \
+               self.source + "\n"
 
 
 class ListAttribute(Leaf):
+    __slots__ = ()
+
     def __init__(self, root, assignee, source):
         super().__init__(root, assignee, source)
 
     def __repr__(self):
-        return "Statement: " + self.assignee
+        return "Statement: " + correct_value(self.assignee)
 
-    def write(self, file_handle, tab_count):
-        tabs = "    " * tab_count
-        file_handle.write(tabs + self.assignee + " #ORIGIN = " + self.source + "\n")
+    def _compute_hash(self):
+        return _digest(b"L", (correct_value(self.assignee),))
 
-    def write_to_text(self, tab_count):
-        tabs = "    " * tab_count
-        return tabs + self.assignee + " #ORIGIN = " + self.source
+    def _clone(self, root):
+        return ListAttribute(root, self.assignee, self.source)
+
+    def to_line(self, tab_count):
+        return indent(tab_count) + correct_value(self.assignee) + " #ORIGIN = " + self.source + "\n"
 
 
 class Node(MetadataHolder):
+    __slots__ = ("attributes", "children", "is_pruned", "_attribute_index", "_node_index")
 
     use_default = True  # TODO: Remove this
 
@@ -104,6 +211,10 @@ class Node(MetadataHolder):
         self.children = list()
         self.is_pruned = False
 
+        # Key -> entries lookups, only built on the first query (most nodes are never queried) then kept up to date
+        self._attribute_index = None
+        self._node_index = None
+
         # TODO: We can modify this later with assignment digging to identify when an id / key is provided (its key)
         if self.use_default:
             real_index = key
@@ -118,6 +229,9 @@ class Node(MetadataHolder):
 
         attribute.set_parent(self)
         self.attributes.append(attribute)
+        self.invalidate_hash()
+        if self._attribute_index is not None:
+            _index_add(self._attribute_index, attribute)
 
     def add_node(self, node):
         if not isinstance(node, Node):
@@ -127,29 +241,112 @@ class Node(MetadataHolder):
 
         node.set_parent(self)
         self.children.append(node)
+        self.invalidate_hash()
+        if self._node_index is not None:
+            _index_add(self._node_index, node)
+
+    def remove_attribute(self, attribute):
+        self.attributes.remove(attribute)
+        self.invalidate_hash()
+        if self._attribute_index is not None:
+            _index_remove(self._attribute_index, attribute)
+
+        attribute.set_parent(None)
+
+    def remove_node(self, node):
+        self.children.remove(node)
+        self.invalidate_hash()
+        if self._node_index is not None:
+            _index_remove(self._node_index, node)
+
+        node.set_parent(None)
+
+    # Lookups return the live index entries (in insertion order) so must not be modified by the caller
+    def replace(self, old, new):
+        # Swap a child attribute or node for another of the same kind, keeping its position
+        if isinstance(old, Leaf):
+            holders = self.attributes
+            index = self._attribute_index
+        else:
+            holders = self.children
+            index = self._node_index
+
+        holders[holders.index(old)] = new
+        if index is not None:
+            if old.key == new.key:
+                entries = index[old.key]
+                entries[entries.index(old)] = new
+            else:
+                _index_remove(index, old)
+                _index_add(index, new)
 
-    def write(self, file_handle, tab_count):
-        tabs = "    " * tab_count
-        file_handle.write(tabs + self.assignee + " = {\n")
-        tab_count += 1
+        old.set_parent(None)
+        new.set_parent(self)
+        self.invalidate_hash()
 
-        # Write out our node content
-        for attribute in self.attributes:
-            attribute.write(file_handle, tab_count)
+    def get_attributes(self, key):
+        if self._attribute_index is None:
+            self._attribute_index = _build_index(self.attributes)
+
+        return self._attribute_index.get(key, _EMPTY)
+
+    def get_nodes(self, key):
+        if self._node_index is None:
+            self._node_index = _build_index(self.children)
+
+        return self._node_index.get(key, _EMPTY)
+
+    def find_attribute(self, key):
+        attributes = self.get_attributes(key)
+        return attributes[0] if len(attributes) > 0 else None
+
+    def find_node(self, key):
+        nodes = self.get_nodes(key)
+        return nodes[0] if len(nodes) > 0 else None
 
-        for node in self.children:
-            node.write(file_handle, tab_count)
+    def write(self, file_handle, tab_count):
+        TextEmitter(file_handle.write).emit(self, tab_count).flush()
 
-        tab_count -= 1
-        file_handle.write(tabs + "} #ORIGIN = " + self.source + "\n")
+    def write_to_text(self, tab_count):
+        return TextEmitter().emit(self, tab_count).text()
 
     def write_header_to_text(self, tab_count):
-        tabs = "    " * tab_count
-        return tabs + self.assignee + " = {\n"
+        return indent(tab_count) + self.assignee + " = {\n"
 
     def write_footer_to_text(self, tab_count):
-        tabs = "    " * tab_count
-        return tabs + "} #ORIGIN = " + self.source + "\n"
+        return indent(tab_count) + "} #ORIGIN = " + self.source + "\n"
+
+    def _compute_hash(self):
+        digest = hashlib.blake2b(b"N" + self.key.encode("utf-8", "surrogatepass") + b"\0", digest_size=_DIGEST_SIZE)
+        for attribute in self.attributes:
+            digest.update(attribute.structural_hash())
+
+        for child in self.children:
+            digest.update(child.structural_hash())
+
+        return digest.digest()
+
+    def _clone(self, root):
+        node = Node(root, self.key, self.source)
+        for attribute in self.attributes:
+            node.add_attribute(attribute.clone(root))
+
+        for child in self.children:
+            node.add_node(child.clone(root))
+
+        return node
+
+    def get_leaves(self):
+        leaves = self.root_graph.get_tree_index().get_leaves(self)
+        if leaves is None:  # Not attached to the document
+            return list(self._iterate_leaves())
+
+        return leaves
+
+    def _iterate_leaves(self):
+        yield from self.attributes
+        for child in self.children:
+            yield from child._iterate_leaves()
 
     def traverse_rootwards(self):
         return self.parent
@@ -164,39 +361,170 @@ class Node(MetadataHolder):
         return "Node: " + self.assignee + " with " + str(len(self.children)) + " children and " + str(len(self.attributes)) + " assignments"
 
 
+_EMPTY = ()
+_DIGEST_SIZE = 16
+
+
+def _digest(kind, parts):
+    return hashlib.blake2b(kind + "\0".join(parts).encode("utf-8", "surrogatepass"), digest_size=_DIGEST_SIZE).digest()
+
+
+def _build_index(holders):
+    index = dict()
+    for holder in holders:
+        _index_add(index, holder)
+
+    return index
+
+
+def _index_add(index, holder):
+    entries = index.get(holder.key)
+    if entries is None:
+        index[holder.key] = [holder]
+    else:
+        entries.append(holder)
+
+
+def _index_remove(index, holder):
+    entries = index[holder.key]
+    entries.remove(holder)
+    if len(entries) == 0:
+        del index[holder.key]
+
+
+class Diagnostic:
+    __slots__ = ("line", "column", "message")
+
+    def __init__(self, line, column, message):
+        self.line = line
+        self.column = column
+        self.message = message
+
+    def __repr__(self):
+        return "line " + str(self.line) + ", column " + str(self.column) + ": " + self.message
+
+
+class TreeIndex:
+    # Everything the comparator repeatedly asks about the shape of a document, calculated in a single pass. This is
+    # rebuilt on demand whenever the shape of the document changes.
+    __slots__ = ("objects", "leaf_order", "leaf_starts", "leaf_ends", "branch_paths", "branch_successors")
+
+    def __init__(self, document):
+        count = len(document.objects)
+        self.objects = document.objects
+        self.leaf_order = array("l")  # Ids of every leaf in document order
+        self.leaf_starts = array("l", [-1]) * count  # Id -> range within leaf_order of the leaves beneath it
+        self.leaf_ends = array("l", [-1]) * count
+        self.branch_paths = [None] * count  # Id -> keys of the holder's ancestors (excluding the document)
+        self.branch_successors = array("l", range(count))  # Id -> holder beneath the branching point above it
+        self._index_node(document, (), dict())
+
+    def _index_node(self, node, path, paths):
+        # Siblings share the same (interned) path tuple
+        path = paths.setdefault(path, path)
+        leaf_order = self.leaf_order
+        leaf_starts = self.leaf_starts
+        leaf_ends = self.leaf_ends
+        branch_paths = self.branch_paths
+        branch_successors = self.branch_successors
+
+        # Plain trunks pass their successor down whereas the children of a branching point are their own successors
+        successor = -1
+        if node.parent is not None and not node.is_branch_point():
+            successor = branch_successors[node.unique_id]
+
+        leaf_starts[node.unique_id] = len(leaf_order)
+        for attribute in node.attributes:
+            unique_id = attribute.unique_id
+            branch_paths[unique_id] = path
+            if successor >= 0:
+                branch_successors[unique_id] = successor
+
+            leaf_starts[unique_id] = len(leaf_order)
+            leaf_order.append(unique_id)
+            leaf_ends[unique_id] = len(leaf_order)
+
+        for child in node.children:
+            unique_id = child.unique_id
+            branch_paths[unique_id] = path
+            if successor >= 0:
+                branch_successors[unique_id] = successor
+
+            self._index_node(child, path + (child.key,), paths)
+
+        leaf_ends[node.unique_id] = len(leaf_order)
+
+    def get_leaves(self, holder):
+        start = self.leaf_starts[holder.unique_id]
+        if start < 0:
+            return None
+
+        objects = self.objects
+        leaf_order = self.leaf_order
+        return [objects[leaf_order[index]] for index in range(start, self.leaf_ends[holder.unique_id])]
+
+
 class Document(Node):
+    __slots__ = ("objects", "parents", "diagnostics", "tree_index")
+
     def __init__(self, assignee, source):
-        self.__id_count = 0
-        self.node_keys = list()
-        self.objects = dict()
+        # Dense tables indexed by the unique ids we hand out, so that any id resolves in O(1)
+        self.objects = list()  # Id -> holder
+        self.parents = array("l")  # Id -> parent id, -1 for none
+        self.diagnostics = list()  # Problems encountered (and skipped) whilst parsing this document
+        self.tree_index = None
         super().__init__(self, assignee, source)
 
     def __repr__(self):
         return "Document for: " + self.assignee
 
-    def add_node(self, node):
-        # We expect that at this level, each node has a unique identifier *somewhere*. See Node for more info
-        if node.key in self.node_keys:
-            print("Non unique level 1 node.")
-            exit(1)
+    def add_diagnostic(self, diagnostic):
+        self.diagnostics.append(diagnostic)
 
-        super().add_node(node)
+    def allocate_id(self, obj):
+        unique_id = len(self.objects)
+        self.objects.append(obj)
+        self.parents.append(-1)
+        return unique_id
 
-    def get_unique_id(self, obj):
-        if obj in self.objects:
-            return self.objects[obj]
+    def get_path(self, unique_id):
+        # Keys from (but excluding) the document, which is always id 0, down to the given holder
+        path = list()
+        parents = self.parents
+        while unique_id > 0:
+            path.append(self.objects[unique_id].key)
+            unique_id = parents[unique_id]
 
-        unique_id = self.__id_count
-        self.__id_count += 1
-        self.objects[obj] = unique_id
-        return unique_id
+        path.reverse()
+        return tuple(path)
 
-    def write(self, file_handle, tab_count):
-        for attribute in self.attributes:
-            attribute.write(file_handle, tab_count)
+    def get_tree_index(self):
+        if self.tree_index is None:
+            self.tree_index = TreeIndex(self)
 
-        for node in self.children:
-            node.write(file_handle, tab_count)
+        return self.tree_index
+
+    def adopt(self, document):
+        # Moves everything from another document onto the end of this one. Holders are registered in the order the
+        # other document allocated them, so stitching together documents parsed from consecutive pieces of a source
+        # gives the same ids as parsing the whole source at once.
+        start = len(self.objects) - 1
+        for holder in document.objects[1:]:
+            holder.root_graph = self
+            holder.unique_id = self.allocate_id(holder)
+
+        for unique_id in range(1, len(document.objects)):
+            parent_id = document.parents[unique_id]
+            if parent_id > 0:
+                self.parents[unique_id + start] = parent_id + start
+
+        for attribute in document.attributes:
+            self.add_attribute(attribute)
+
+        for child in document.children:
+            self.add_node(child)
+
+        self.tree_index = None
 
     def compare(self, diff_record, cannonical_document):
         # Loop though our assignments - identical keys are identical
@@ -208,11 +536,7 @@ class Document(Node):
                 diff_record.attribute(attribute, None)
 
     def contains_assignment(self, assignment_to_compare):
-        for assignment in self.children:
-            if assignment.assignee == assignment_to_compare.assignee:
-                return assignment
-
-        return None
+        return self.find_attribute(assignment_to_compare.key)
 
 
 class NodeIterator:
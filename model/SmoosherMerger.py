@@ -0,0 +1,110 @@
+from model import SmoosherDataModel
+
+
+class Conflict:
+    def __init__(self, base, ours, theirs):
+        self.base = base
+        self.ours = ours
+        self.theirs = theirs
+
+    def __repr__(self):
+        return "Conflict between: " + repr(self.ours) + " and: " + repr(self.theirs)
+
+
+class ThreeWayMerge:
+    # Merges the changes made in theirs (relative to a common base) into ours, in place. Edits that do not overlap are
+    # taken automatically, whereas anything both sides changed differently is left as ours and recorded as a conflict.
+    def __init__(self, base, ours, theirs):
+        self.base = base
+        self.ours = ours
+        self.theirs = theirs
+        self.conflicts = list()
+        self.merged_count = 0  # Changes taken from theirs
+
+    def merge(self):
+        self._merge_content(self.base, self.ours, self.theirs)
+        return self.ours
+
+    def get_conflict_count(self):
+        return len(self.conflicts)
+
+    def _merge_content(self, base, ours, theirs):
+        # Attributes and blocks are merged separately as our model keeps them apart
+        kinds = ((base.attributes if base is not None else (), ours.attributes, theirs.attributes),
+                 (base.children if base is not None else (), ours.children, theirs.children))
+        for base_holders, our_holders, their_holders in kinds:
+            base_entries = self._identify(base_holders)
+            our_entries = self._identify(our_holders)
+            their_entries = self._identify(their_holders)
+            for identity, their_holder in their_entries.items():
+                self._merge_entry(ours, base_entries.get(identity), our_entries.get(identity), their_holder)
+
+            # Anything in the base that theirs no longer has was deleted by them
+            for identity, base_holder in base_entries.items():
+                if identity in their_entries:
+                    continue
+
+                our_holder = our_entries.get(identity)
+                if our_holder is None:
+                    continue  # We both deleted it
+
+                if our_holder.equals(base_holder):
+                    self._remove(ours, our_holder)
+                    self.merged_count += 1
+                else:
+                    self.conflicts.append(Conflict(base_holder, our_holder, None))
+
+    def _merge_entry(self, parent, base, ours, theirs):
+        if ours is None:
+            if base is None:
+                parent_add = parent.add_attribute if isinstance(theirs, SmoosherDataModel.Leaf) else parent.add_node
+                parent_add(theirs.clone(self.ours))
+                self.merged_count += 1
+
+            elif not theirs.equals(base):
+                self.conflicts.append(Conflict(base, None, theirs))  # We deleted what they changed
+
+            return
+
+        # Nothing to take from theirs
+        if ours.equals(theirs) or (base is not None and theirs.equals(base)):
+            return
+
+        # Only they changed it
+        if base is not None and ours.equals(base):
+            parent.replace(ours, theirs.clone(self.ours))
+            self.merged_count += 1
+            return
+
+        # We both changed it, blocks may still have changed in different places
+        if isinstance(ours, SmoosherDataModel.Node):
+            self._merge_content(base, ours, theirs)
+        else:
+            self.conflicts.append(Conflict(base, ours, theirs))
+
+    def _remove(self, parent, holder):
+        if isinstance(holder, SmoosherDataModel.Leaf):
+            parent.remove_attribute(holder)
+        else:
+            parent.remove_node(holder)
+
+    def _identify(self, holders):
+        # Blocks carrying an id (events etc.) are identified by it, otherwise repeated keys are told apart by the order
+        # they appear in
+        entries = dict()
+        occurrences = dict()
+        for holder in holders:
+            identity = None
+            if isinstance(holder, SmoosherDataModel.Node):
+                id_attribute = holder.find_attribute("id")
+                if id_attribute is not None:
+                    identity = (holder.key, "id", SmoosherDataModel.correct_value(id_attribute.value))
+
+            if identity is None or identity in entries:
+                occurrence = occurrences.get(holder.key, 0)
+                occurrences[holder.key] = occurrence + 1
+                identity = (holder.key, occurrence)
+
+            entries[identity] = holder
+
+        return entries
@@ -0,0 +1,117 @@
+import concurrent.futures
+import os
+import zipfile
+
+import StellarisModFilesystem
+
+
+def _filesystem(tmp_path):
+    mods = tmp_path / "mods"
+    mods.mkdir()
+    (mods / "test_mod.mod").write_text("")
+    return StellarisModFilesystem.StellarisModFilesystem(str(mods), str(mods / "smooshed"), False, "smooshed")
+
+
+def _directory_mod(path, files):
+    for relative_file, content in files.items():
+        file = os.path.join(str(path), *relative_file.split("/"))
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, "wb") as mod_file:
+            mod_file.write(content)
+
+    return StellarisModFilesystem.DirectoryModSource(str(path))
+
+
+def _archive_mod(path, files):
+    with zipfile.ZipFile(str(path), "w") as archive:
+        for relative_file, content in files.items():
+            archive.writestr(zipfile.ZipInfo(relative_file, (2020, 1, 1, 0, 0, 0)), content)
+
+    return StellarisModFilesystem.ArchiveModSource(str(path))
+
+
+def _migrate(filesystem, assets):
+    hashed = list()
+
+    def digest(source, member):
+        hashed.append(source.describe(member))
+        return source.digest(member)
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        counts = filesystem.migrate_assets(assets, executor, digest)
+
+    return counts, hashed
+
+
+def _target(filesystem, relative_file):
+    return os.path.join(filesystem.target, *relative_file.split("/"))
+
+
+def _read(filesystem, relative_file):
+    with open(_target(filesystem, relative_file), "rb") as target_file:
+        return target_file.read()
+
+
+def test_identical_archive_members_are_extracted_once(tmp_path):
+    filesystem = _filesystem(tmp_path)
+    archive = _archive_mod(tmp_path / "archive.zip", {"gfx/a.dds": b"same", "gfx/b.dds": b"same", "gfx/c.dds": b"diff"})
+    assets = {member: (archive, member) for member in ("gfx/a.dds", "gfx/b.dds", "gfx/c.dds")}
+
+    counts, hashed = _migrate(filesystem, assets)
+    assert counts == {"copied": 2, "linked": 1, "unchanged": 0}
+    assert os.path.samefile(_target(filesystem, "gfx/a.dds"), _target(filesystem, "gfx/b.dds"))
+    assert _read(filesystem, "gfx/c.dds") == b"diff"
+
+    # Members whose checksums differ from everything else of their size are never hashed
+    assert sorted(hashed) == [archive.describe("gfx/a.dds"), archive.describe("gfx/b.dds")]
+
+
+def test_archive_members_are_linked_to_identical_directory_files(tmp_path):
+    filesystem = _filesystem(tmp_path)
+    directory = _directory_mod(tmp_path / "directory", {"gfx/a.dds": b"same"})
+    archive = _archive_mod(tmp_path / "archive.zip", {"gfx/b.dds": b"same"})
+    assets = {"gfx/a.dds": (directory, "gfx/a.dds"), "gfx/b.dds": (archive, "gfx/b.dds")}
+
+    assert _migrate(filesystem, assets)[0] == {"copied": 1, "linked": 1, "unchanged": 0}
+    assert _read(filesystem, "gfx/b.dds") == b"same"
+    assert os.path.samefile(_target(filesystem, "gfx/b.dds"), str(tmp_path / "directory" / "gfx" / "a.dds"))
+
+
+def test_directory_files_are_never_hashed_amongst_themselves(tmp_path):
+    # Copying a directory file is only a link, so there is nothing to save by finding its duplicates
+    filesystem = _filesystem(tmp_path)
+    directory = _directory_mod(tmp_path / "directory", {"gfx/a.dds": b"same", "gfx/b.dds": b"same"})
+    assets = {member: (directory, member) for member in ("gfx/a.dds", "gfx/b.dds")}
+
+    assert _migrate(filesystem, assets) == ({"copied": 2, "linked": 0, "unchanged": 0}, [])
+
+
+def test_up_to_date_assets_are_left_alone(tmp_path):
+    filesystem = _filesystem(tmp_path)
+    directory = _directory_mod(tmp_path / "directory", {"gfx/a.dds": b"same", "gfx/c.dds": b"unique"})
+    archive = _archive_mod(tmp_path / "archive.zip", {"gfx/b.dds": b"same", "gfx/d.dds": b"also_unique"})
+    assets = {"gfx/a.dds": (directory, "gfx/a.dds"), "gfx/b.dds": (archive, "gfx/b.dds"),
+              "gfx/c.dds": (directory, "gfx/c.dds"), "gfx/d.dds": (archive, "gfx/d.dds")}
+    _migrate(filesystem, assets)
+
+    # Only the duplicate still needs checking, as its copy carries its original's timestamp rather than its own
+    counts, hashed = _migrate(filesystem, assets)
+    assert counts == {"copied": 0, "linked": 0, "unchanged": 4}
+    assert sorted(hashed) == sorted([directory.describe("gfx/a.dds"), archive.describe("gfx/b.dds")])
+
+    # Nothing is hashed if no archive member needs extracting
+    del assets["gfx/b.dds"]
+    assert _migrate(filesystem, assets) == ({"copied": 0, "linked": 0, "unchanged": 3}, [])
+
+
+def test_changed_assets_are_copied_again(tmp_path):
+    filesystem = _filesystem(tmp_path)
+    directory = _directory_mod(tmp_path / "directory", {"gfx/a.dds": b"first"})
+    assets = {"gfx/a.dds": (directory, "gfx/a.dds")}
+    _migrate(filesystem, assets)
+
+    # Mods are replaced rather than edited in place, which would also edit the link we copied it to
+    os.unlink(str(tmp_path / "directory" / "gfx" / "a.dds"))
+    _directory_mod(tmp_path / "directory", {"gfx/a.dds": b"second version"})
+    assert _migrate(filesystem, assets)[0] == {"copied": 1, "linked": 0, "unchanged": 0}
+    assert _read(filesystem, "gfx/a.dds") == b"second version"
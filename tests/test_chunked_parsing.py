@@ -0,0 +1,86 @@
+import concurrent.futures
+
+import pytest
+
+import StellarisDataParser
+import StellarisScriptParser
+
+
+class _RecordingExecutor(concurrent.futures.ThreadPoolExecutor):
+    # Chunks are parsed by whatever parser the executor's workers were given, which for threads is this process's
+    def __init__(self, options):
+        super().__init__(2, initializer=StellarisDataParser.initialise_worker, initargs=(options,))
+        self.submitted = list()
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted.append(fn)
+        return super().submit(fn, *args, **kwargs)
+
+
+def _events(count, broken=()):
+    lines = list()
+    for index in range(count):
+        lines.append("event_" + str(index) + " = {\n\tid = ns." + str(index) + "\n\tdesc = \"{ not a block }\"\n"
+                     "\toption = { weight > " + str(index) + " }\n}\n")
+        if index % 3 == 0:
+            lines.append("value_" + str(index) + " = " + str(index) + "\n")
+        if index in broken:
+            lines.append("broken_" + str(index) + " = { a = = }\n")
+
+    return "".join(lines)
+
+
+def _describe(document):
+    # Everything that must not depend on how a document was parsed, down to the ids of every holder
+    return (document.write_to_text(0), [(type(holder).__name__, holder.unique_id, holder.key)
+                                        for holder in document.objects],
+            list(document.parents), [(diagnostic.line, diagnostic.column) for diagnostic in document.diagnostics])
+
+
+def _parser(options, chunk_size):
+    parser = StellarisDataParser.StellarisDataParser(**options)
+    parser.chunk_size = chunk_size
+    return parser
+
+
+def test_statements_are_split_between_top_level_blocks():
+    src = _events(10)
+    starts = StellarisScriptParser.split_statements(src, 100)
+    assert starts[0] == 0 and len(starts) > 2
+    for start, end in zip(starts, starts[1:]):
+        assert end - start >= 100
+        assert src[end:].startswith("event_")
+
+
+def test_sources_are_not_split_within_blocks():
+    src = "outer = {\n" + _events(10) + "}\n"
+    assert StellarisScriptParser.split_statements(src, 100) == [0]
+
+
+@pytest.mark.parametrize("src", ["a = { b = 1\n", "a = 1\n}\nb = { c = 2 }\n"])
+def test_unbalanced_sources_are_not_split(src):
+    assert StellarisScriptParser.split_statements(src, 1) is None
+
+
+@pytest.mark.parametrize("engine", StellarisDataParser.StellarisDataParser.engines)
+@pytest.mark.parametrize("recover", [False, True])
+def test_chunked_documents_match_serial_ones(engine, recover):
+    options = {"engine": engine, "recover": recover}
+    src = _events(100, {7, 50} if recover else ())
+    serial = _parser(options, 512).parse_model("test_mod", "test_file.txt", src)
+    with _RecordingExecutor(options) as executor:
+        chunked = _parser(options, 512).parse_model("test_mod", "test_file.txt", src, executor=executor)
+
+    assert len(executor.submitted) > 1
+    assert _describe(chunked) == _describe(serial)
+
+
+def test_sources_that_cannot_be_split_are_still_parsed_by_the_workers():
+    options = {"engine": "native", "recover": True}
+    src = _events(100) + "unclosed = {\n"
+    serial = _parser(options, 512).parse_model("test_mod", "test_file.txt", src)
+    with _RecordingExecutor(options) as executor:
+        whole = _parser(options, 512).parse_model("test_mod", "test_file.txt", src, executor=executor)
+
+    assert executor.submitted == [StellarisDataParser.parse_chunk]
+    assert _describe(whole) == _describe(serial)
@@ -0,0 +1,44 @@
+import StellarisDataParser
+from model import SmoosherMerger
+
+base_src = "a = { b = 1 c = 2 }\nd = { e = 3 }\nf = 4\n"
+
+
+def _parse(src, mod="test_mod"):
+    return StellarisDataParser.StellarisDataParser(engine="native").parse_model(mod, "test_file.txt", src)
+
+
+def _merge(ours_src, theirs_src):
+    merge = SmoosherMerger.ThreeWayMerge(_parse(base_src, "vanilla"), _parse(ours_src, "ours"),
+                                         _parse(theirs_src, "theirs"))
+    merged = merge.merge()
+    return merge, merged.write_to_text(0)
+
+
+def test_edits_that_do_not_overlap_are_taken():
+    merge, text = _merge("a = { b = 10 c = 2 }\nd = { e = 3 }\nf = 4\n", "a = { b = 1 c = 20 }\nd = { e = 3 }\nf = 4\n")
+    assert merge.get_conflict_count() == 0
+    assert "b = 10 #ORIGIN = ours" in text
+    assert "c = 20 #ORIGIN = theirs" in text
+
+
+def test_additions_and_deletions_are_taken():
+    merge, text = _merge(base_src, "a = { b = 1 c = 2 }\nf = 4\ng = 5\n")
+    assert merge.get_conflict_count() == 0
+    assert merge.merged_count == 2
+    assert "d = {" not in text
+    assert "g = 5 #ORIGIN = theirs" in text
+
+
+def test_overlapping_edits_are_conflicts():
+    merge, text = _merge("a = { b = 10 c = 2 }\nd = { e = 3 }\nf = 4\n", "a = { b = 11 c = 2 }\nd = { e = 3 }\nf = 4\n")
+    assert merge.get_conflict_count() == 1
+    conflict = merge.conflicts[0]
+    assert (conflict.base.value, conflict.ours.value, conflict.theirs.value) == (1, 10, 11)
+    assert "b = 10 #ORIGIN = ours" in text
+
+
+def test_changing_what_the_other_deleted_is_a_conflict():
+    merge, text = _merge("a = { b = 1 c = 2 }\nf = 4\n", "a = { b = 1 c = 2 }\nd = { e = 30 }\nf = 4\n")
+    assert merge.get_conflict_count() == 1
+    assert merge.conflicts[0].ours is None
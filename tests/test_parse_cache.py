@@ -0,0 +1,42 @@
+import os
+
+import StellarisParseCache
+
+
+def test_stored_entries_load_back(tmp_path):
+    cache = StellarisParseCache.StellarisParseCache(str(tmp_path), 1)
+    key = cache.key("native", "test_mod", "a = 1\n")
+    cache.store(key, {"a": 1})
+    assert cache.load(key) == {"a": 1}
+    assert cache.load(cache.key("native", "test_mod", "a = 2\n")) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_keys_depend_on_everything_that_changes_the_result(tmp_path):
+    cache = StellarisParseCache.StellarisParseCache(str(tmp_path), 1)
+    key = cache.key("native", "test_mod", "a = 1\n")
+    assert key != cache.key("pyparsing", "test_mod", "a = 1\n")
+    assert key != cache.key("native", "other_mod", "a = 1\n")
+    assert key != StellarisParseCache.StellarisParseCache(str(tmp_path), 2).key("native", "test_mod", "a = 1\n")
+
+
+def test_unreadable_entries_are_discarded(tmp_path):
+    cache = StellarisParseCache.StellarisParseCache(str(tmp_path), 1)
+    key = cache.key("native", "test_mod", "a = 1\n")
+    with open(os.path.join(str(tmp_path), key), "wb") as cache_file:
+        cache_file.write(b"not a pickle")
+
+    assert cache.load(key) is None
+    assert not os.path.exists(os.path.join(str(tmp_path), key))
+
+
+def test_size_is_bounded_across_caches_sharing_a_directory(tmp_path):
+    # Each worker process has its own cache object, none of which see the others' writes
+    caches = [StellarisParseCache.StellarisParseCache(str(tmp_path), 1, max_size=64 * 1024) for worker in range(4)]
+    for index in range(100):
+        for worker, cache in enumerate(caches):
+            cache.store(cache.key("native", str(worker), str(index)), os.urandom(1024))
+
+    size = sum(entry.stat().st_size for entry in os.scandir(str(tmp_path)))
+    overshoot = len(caches) * StellarisParseCache.StellarisParseCache.measure_interval * 1100
+    assert size <= 64 * 1024 + overshoot
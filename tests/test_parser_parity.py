@@ -0,0 +1,93 @@
+import pyparsing as pp
+import pytest
+
+import StellarisDataParser
+import StellarisScriptParser
+from model import SmoosherDataModel
+
+# Scripts both engines must read into exactly the same model
+valid_samples = {
+    "assignments": "a = 1\nb = -2.5\nc = +3\nd = yes\ne = NO\nf = some_value\ng = \"quoted value\"\n",
+    "nested_blocks": "a = {\n\tb = {\n\t\tc = 1\n\t\td = { e = f }\n\t}\n\tg = 2\n}\n",
+    "empty_blocks": "a = { }\nb = {\n}\nc = { d = {} }\n",
+    "quoted_keys": "\"a\" = { \"b\" = 1 \"c_d\" = \"e\" }\n\"f.g\" = 2\n",
+    "queries": "a = { b > 1 c < 2 d >= 3.5 e <= -4 f > yes }\n",
+    "lone_values": "a = { 1 2.5 yes \"three\" four }\n",
+    "origins": "a = 1 #ORIGIN = first_mod\nb = { c = 2 #ORIGIN = second_mod\n} #ORIGIN = third_mod\n",
+    "partial_tokens": "a = { b = 10abc c = yesno d = 1.5x e = -3.fifty f = noon }\n",
+    "keyword_glue": "a = { b = yes_please c = _no d = no5 e = yes.no }\n",
+    "eight_bit": "a = { name = Zoë b = été über = 1 }\n",
+    "comments": "# Leading comment\na = { # trailing\n\tb = 1 # with { braces }\n}\n",
+    "missing_equals": "a{\n\tb = 1\n}\nc = {d{ e = 1 }}\n",
+    "descriptor": "name=\"Some Mod\"\ntags={\n\t\"Gameplay\"\n}\nsupported_version=\"2.7.*\"\n",
+}
+
+# Scripts that must be rejected by both engines
+invalid_samples = {
+    "unclosed_block": "a = { b = 1\n",
+    "stray_close": "a = 1\n}\n",
+    "missing_value": "a = { b = }\n",
+    "double_equals": "a = { b = = 1 }\n",
+    "lone_root_value": "a = 1\nvalue\n",
+    "origin_without_source": "a = 1 #ORIGIN = \n",
+}
+
+# Scripts with some good content that recovering engines must agree on
+recoverable_samples = {
+    "bad_middle_block": "a = { b = 1 }\nc = { d = = }\ne = { f = 2 }\n",
+    "unterminated_quote": "x = { y = \"unterminated }\nz = { w = 1 }\n",
+    "unclosed_last_block": "a = { b = 1 }\nc = { d = 2\n",
+    "several_errors": "a = { = }\nb = { c = 1 }\nd = { e = = }\nf = { g = 2 }\n",
+}
+
+
+def _parse(engine, src, recover=False):
+    parser = StellarisDataParser.StellarisDataParser(engine=engine, recover=recover)
+    return parser.parse_model("test_mod", "test_file.txt", src)
+
+
+def _describe(holder):
+    # Everything about a holder that ends up in our output, including value types which the text can hide
+    if isinstance(holder, SmoosherDataModel.Node):
+        return (type(holder).__name__, holder.key, holder.source,
+                [_describe(attribute) for attribute in holder.attributes],
+                [_describe(child) for child in holder.children])
+
+    value = getattr(holder, "value", holder.assignee)
+    return type(holder).__name__, holder.key, getattr(holder, "type", None), value, type(value).__name__, holder.source
+
+
+@pytest.mark.parametrize("name", sorted(valid_samples))
+def test_engines_build_the_same_model(name):
+    pyparsing_model = _parse("pyparsing", valid_samples[name])
+    native_model = _parse("native", valid_samples[name])
+
+    assert native_model.write_to_text(0) == pyparsing_model.write_to_text(0)
+    assert _describe(native_model) == _describe(pyparsing_model)
+
+
+@pytest.mark.parametrize("name", sorted(invalid_samples))
+def test_engines_reject_the_same_input(name):
+    with pytest.raises(pp.ParseException):
+        _parse("pyparsing", invalid_samples[name])
+
+    with pytest.raises(StellarisScriptParser.StellarisParseError):
+        _parse("native", invalid_samples[name])
+
+
+@pytest.mark.parametrize("name", sorted(valid_samples))
+def test_recovering_changes_nothing_for_valid_input(name):
+    for engine in StellarisDataParser.StellarisDataParser.engines:
+        model = _parse(engine, valid_samples[name], recover=True)
+        assert model.diagnostics == []
+        assert model.write_to_text(0) == _parse(engine, valid_samples[name]).write_to_text(0)
+
+
+@pytest.mark.parametrize("name", sorted(recoverable_samples))
+def test_engines_recover_the_same_content(name):
+    pyparsing_model = _parse("pyparsing", recoverable_samples[name], recover=True)
+    native_model = _parse("native", recoverable_samples[name], recover=True)
+
+    # The engines describe problems differently but must skip the same statements
+    assert len(native_model.diagnostics) == len(pyparsing_model.diagnostics) > 0
+    assert native_model.write_to_text(0) == pyparsing_model.write_to_text(0)
@@ -0,0 +1,85 @@
+import os
+
+import StellarisModFilesystem
+import StellarisRunManifest
+
+options = {"engine": "native", "treediff": False}
+
+
+def _mod(path, files):
+    for relative_file, content in files.items():
+        file = os.path.join(path, *relative_file.split("/"))
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, "w") as mod_file:
+            mod_file.write(content)
+
+    return StellarisModFilesystem.DirectoryModSource(path)
+
+
+def _build(target, source, manifest_options=options):
+    # Pretend to smoosh a single contributor into a target of the same name, as a run would
+    manifest = StellarisRunManifest.StellarisRunManifest(target, manifest_options)
+    signature = manifest.signature([("test_mod", source, "common/a.txt")])
+    file = os.path.join(target, "common", "a.txt")
+    current = manifest.is_current(file, signature)
+    if not current:
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        open(file, "w").close()
+        manifest.record(file, signature)
+
+    stale = manifest.record_assets({"gfx/a.dds": (source, "gfx/a.dds")})
+    manifest.save()
+    return current, stale
+
+
+def test_unchanged_targets_are_current(tmp_path):
+    target = str(tmp_path / "target")
+    os.makedirs(target)
+    source = _mod(str(tmp_path / "mod"), {"common/a.txt": "a = 1\n"})
+    assert _build(target, source) == (False, [])
+    assert StellarisRunManifest.StellarisRunManifest.exists(target)
+    assert _build(target, source) == (True, [])
+
+
+def test_changed_contributors_are_rebuilt(tmp_path):
+    target = str(tmp_path / "target")
+    os.makedirs(target)
+    source = _mod(str(tmp_path / "mod"), {"common/a.txt": "a = 1\n"})
+    _build(target, source)
+    _mod(str(tmp_path / "mod"), {"common/a.txt": "a = 22\n"})
+    assert _build(target, source)[0] is False
+
+
+def test_stale_outputs_are_found_after_the_options_change(tmp_path):
+    target = str(tmp_path / "target")
+    os.makedirs(target)
+    source = _mod(str(tmp_path / "mod"), {"common/a.txt": "a = 1\n"})
+    manifest = StellarisRunManifest.StellarisRunManifest(target, options)
+    manifest.record(os.path.join(target, "common", "b.txt"), [])
+    manifest.record_assets({"gfx/a.dds": (source, "gfx/a.dds"), "gfx/b.dds": (source, "gfx/b.dds")})
+    manifest.save()
+
+    # Everything has to be rebuilt, but whatever nothing provides any more still needs removing
+    changed_options = dict(options, treediff=True)
+    manifest = StellarisRunManifest.StellarisRunManifest(target, changed_options)
+    assert manifest.stale_targets([os.path.join(target, "common", "a.txt")]) == [
+        os.path.join(target, "common/b.txt")]
+    assert manifest.record_assets({"gfx/a.dds": (source, "gfx/a.dds")}) == [os.path.join(target, "gfx", "b.dds")]
+    assert _build(target, source, changed_options)[0] is False
+
+
+def test_asset_hashes_are_remembered(tmp_path):
+    target = str(tmp_path / "target")
+    os.makedirs(target)
+    source = _mod(str(tmp_path / "mod"), {"gfx/a.dds": "a"})
+    manifest = StellarisRunManifest.StellarisRunManifest(target, options)
+    manifest.record_assets({"gfx/a.dds": (source, "gfx/a.dds")})
+    digest = manifest.hash_file(source, "gfx/a.dds")
+    manifest.save()
+
+    def digest_again(member):
+        raise AssertionError("An unchanged asset was hashed again")
+
+    source.digest = digest_again
+    manifest = StellarisRunManifest.StellarisRunManifest(target, options)
+    assert manifest.hash_file(source, "gfx/a.dds") == digest
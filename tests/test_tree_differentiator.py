@@ -0,0 +1,104 @@
+import random
+
+import pytest
+
+import StellarisDataParser
+from model import SmoosherComparator
+
+differentiators = [SmoosherComparator.DataDifferentiator, SmoosherComparator.TreeDifferentiator]
+
+
+def _parse(src):
+    return StellarisDataParser.StellarisDataParser(engine="native").parse_model("test_mod", "test_file.txt", src)
+
+
+def _compare(differentiator, original_src, latest_src):
+    differ = differentiator(_parse(original_src), _parse(latest_src))
+    differ.compare()
+    return differ
+
+
+def _types(changes):
+    return sorted(difference.type for difference in changes.values())
+
+
+def _events(count, edited=(), reverse=False):
+    lines = list()
+    for index in range(count):
+        flag = "flag_" + str(index) + ("_edited" if index in edited else "")
+        lines.append("country_event = {\n\tid = ns." + str(index) + "\n\ttrigger = { has_flag = " + flag + " }\n"
+                     "\toption = { name = ns." + str(index) + ".a\n\t\tadd_resource = { energy = " + str(index) + " }\n"
+                     "\t}\n}\n")
+
+    return "".join(reversed(lines) if reverse else lines)
+
+
+def _assert_paired_with_themselves(differ, edited):
+    changes = [difference for difference in differ.original_changes.values() if difference.type == "change"]
+    assert len(changes) == len(edited)
+    for change in changes:
+        assert _event_id(change.original) == _event_id(change.latest)
+
+
+def _event_id(holder):
+    while holder.key != "country_event":
+        holder = holder.parent
+
+    return holder.find_attribute("id").value
+
+
+@pytest.mark.parametrize("differentiator", differentiators)
+def test_identical_documents_have_no_differences(differentiator):
+    src = "a = { b = 1 c = { d = 2 } }\ne = 3\n"
+    differ = _compare(differentiator, src, src)
+    assert differ.get_conflict_count() == 0
+
+
+@pytest.mark.parametrize("differentiator", differentiators)
+def test_edits_are_reported(differentiator):
+    differ = _compare(differentiator, "a = { b = 1 }\nc = { d = 2 }\n", "a = { b = 5 }\nc = { d = 2 }\ne = 3\n")
+    assert _types(differ.original_changes) == ["change"]
+    assert _types(differ.latest_changes) == ["addition", "change"]
+
+
+def test_reordered_blocks_are_moves():
+    differ = _compare(SmoosherComparator.TreeDifferentiator, "x = { a = 1 }\ny = { b = 2 c = 3 }\n",
+                      "y = { b = 2 c = 3 }\nx = { a = 1 }\n")
+    assert set(_types(differ.original_changes)) == {"move"}
+    assert set(_types(differ.latest_changes)) == {"move"}
+
+
+def test_edited_blocks_sharing_a_key_pair_by_similarity():
+    # Blocks with the same key are paired bottom up with whichever is most alike, not just the next one along
+    edited = set(range(0, 40, 2))
+    differ = _compare(SmoosherComparator.TreeDifferentiator, _events(40), _events(40, edited, reverse=True))
+    _assert_paired_with_themselves(differ, edited)
+
+
+def test_many_blocks_sharing_a_key_pair_after_an_insertion():
+    edited = set(range(0, 200, 2))
+    inserted = "country_event = {\n\tid = ns.new\n\ttrigger = { has_flag = new }\n}\n"
+    differ = _compare(SmoosherComparator.TreeDifferentiator, _events(200), inserted + _events(200, edited))
+    _assert_paired_with_themselves(differ, edited)
+    assert _types(differ.latest_changes).count("addition") == 1
+    assert "move" not in _types(differ.original_changes)
+
+
+def test_many_shuffled_blocks_sharing_a_key_pair_by_similarity():
+    edited = set(range(0, 300, 3))
+    blocks = _events(300, edited).split("country_event = {")[1:]
+    random.Random(1).shuffle(blocks)
+    differ = _compare(SmoosherComparator.TreeDifferentiator, _events(300),
+                      "".join("country_event = {" + block for block in blocks))
+    _assert_paired_with_themselves(differ, edited)
+
+
+def test_blocks_with_little_in_common_pair_by_id():
+    # Too little of each block survives for them to pair by similarity, but their ids still say which is which
+    def events(indices, edited=()):
+        return "".join("country_event = {\n\tid = ns." + str(index) + "\n\ttrigger = { has_flag = flag_" + str(index) +
+                       ("_edited" if index in edited else "") + " }\n}\n" for index in indices)
+
+    edited = set(range(100))
+    differ = _compare(SmoosherComparator.TreeDifferentiator, events(range(100)), events(reversed(range(100)), edited))
+    _assert_paired_with_themselves(differ, edited)